@@ -3,6 +3,8 @@ from datetime import datetime
 import os
 import pandas as pd
 from db_service import db_service
+from answer_cache import get_answer_cache
+from llm_scheduler import get_llm_scheduler
 
 
 def render_analytics_dashboard():
@@ -117,20 +119,56 @@ def render_analytics_dashboard():
 
     # Calculate average chunk size
     if doc_stats["total_chunks"] > 0:
-        # total_chars = sum(len(chunk.get('text', '')) for chunk in db_service.chunks.values())
         total_chars = sum(
-            len(chunk.get("text", "")) for chunk in db_service.chunks.find()
+            len(chunk.get("text", "")) for chunk in db_service.chunks.values()
         )
         avg_chunk_size = total_chars / doc_stats["total_chunks"]
         st.metric("Average Chunk Size (characters)", round(avg_chunk_size, 2))
 
         # Chunk size distribution
-        # chunk_sizes = [len(chunk.get('text', '')) for chunk in db_service.chunks.values()]
-        chunk_sizes = [len(chunk.get("text", "")) for chunk in db_service.chunks.find()]
+        chunk_sizes = [len(chunk.get("text", "")) for chunk in db_service.chunks.values()]
         st.subheader("Chunk Size Distribution")
         chunk_df = pd.DataFrame({"Chunk": range(len(chunk_sizes)), "Size": chunk_sizes})
         st.line_chart(chunk_df.set_index("Chunk"), color="#00A1DE")  # Pool Blue
 
+    # Embedding memory (shared vector store)
+    if "vector_store" in st.session_state:
+        embedding_stats = st.session_state.vector_store.store.embedding_memory_stats()
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric(
+                f"Embedding Memory (MB, {embedding_stats['dtype']})",
+                round(embedding_stats["bytes"] / 1024**2, 2),
+            )
+        with col2:
+            st.metric(
+                "Saved vs Python lists (MB)",
+                round(embedding_stats["bytes_saved"] / 1024**2, 2),
+            )
+
+    # Assistant requests (all sessions of this process)
+    st.header("🤖 Assistant Requests")
+    scheduler_stats = get_llm_scheduler().stats()
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("In Progress", scheduler_stats["active"])
+    with col2:
+        st.metric("Queued", scheduler_stats["queued"])
+    with col3:
+        st.metric("Average Wait (s)", round(scheduler_stats["avg_wait_seconds"], 2))
+    with col4:
+        st.metric("Max Wait (s)", round(scheduler_stats["max_wait_seconds"], 2))
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Rate Limited", scheduler_stats["rate_limited"])
+    with col2:
+        st.metric("Retries", scheduler_stats["retries"])
+    with col3:
+        st.metric(
+            "Answer Cache Hit Rate (%)",
+            round(get_answer_cache().stats()["hit_rate"] * 100, 1),
+        )
+
     # Footer with Neuai branding and logo
     st.markdown("---")
     col1, col2 = st.columns([3, 1])
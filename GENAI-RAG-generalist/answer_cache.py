@@ -0,0 +1,149 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+__all__ = ['AnswerCache', 'get_answer_cache', 'context_key']
+
+logger = logging.getLogger(__name__)
+
+# Answers kept at most; 0 disables the cache
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 1000))
+# Seconds an answer is served before the assistant is asked again
+ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', 3600))
+# Cosine similarity at which two questions over the same context get the same answer;
+# questions that merely share a topic score well below this
+ANSWER_CACHE_MIN_SIMILARITY = float(os.environ.get('ANSWER_CACHE_MIN_SIMILARITY', 0.95))
+
+
+@dataclass
+class _Entry:
+    bucket: Tuple
+    scope: Optional[str]
+    embedding: np.ndarray
+    answer: str
+    created: float
+
+
+def context_key(context_metadata: List[Dict]) -> str:
+    """Hash of the retrieved chunks, in the order they were given to the assistant.
+
+    Filenames are part of it: a shared document is named after each uploader.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for metadata in context_metadata:
+        digest.update(f"{metadata.get('document_id')}\0{metadata.get('chunk_index')}\0"
+                      f"{metadata.get('filename')}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class AnswerCache:
+    """Assistant answers reused for similar questions over the same context.
+
+    Answers are grouped by assistant and by the chunks retrieved for the
+    question; within a group the closest earlier question is reused when
+    its (normalized) embedding is at least min_similarity from the new
+    one. Entries expire after ttl seconds and the least recently used are
+    evicted beyond max_items. A scope (the documents' group) is dropped as
+    a whole when documents are added to it.
+
+    Only standalone questions belong here: the caller skips the cache for
+    follow-ups in a conversation and for questions without retrieved
+    context, whose answers depend on more than the key.
+    """
+
+    def __init__(self, max_items: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 min_similarity: float = ANSWER_CACHE_MIN_SIMILARITY):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[int, _Entry]' = OrderedDict()
+        self._buckets: Dict[Tuple, List[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, scope: Optional[str], assistant_id: str, context_metadata: List[Dict],
+            embedding: np.ndarray) -> Optional[str]:
+        """The cached answer to a similar question over the same context, or None."""
+        if not self.max_items:
+            return None
+        bucket = (scope, assistant_id, context_key(context_metadata))
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_similarity = None, self.min_similarity
+            for entry_id in list(self._buckets.get(bucket, ())):
+                entry = self._entries[entry_id]
+                if now - entry.created > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                similarity = float(np.dot(entry.embedding, embedding))
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id].answer
+
+    def put(self, scope: Optional[str], assistant_id: str, context_metadata: List[Dict],
+            embedding: np.ndarray, answer: str) -> None:
+        if not self.max_items:
+            return
+        bucket = (scope, assistant_id, context_key(context_metadata))
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _Entry(bucket, scope, np.asarray(embedding, dtype='float32'),
+                                             answer, time.monotonic())
+            self._buckets.setdefault(bucket, []).append(entry_id)
+            while len(self._entries) > self.max_items:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, scope: Optional[str]) -> None:
+        """Drop the answers over a scope's documents (its context may have changed)."""
+        with self._lock:
+            stale = [entry_id for entry_id, entry in self._entries.items() if entry.scope == scope]
+            for entry_id in stale:
+                self._remove(entry_id)
+        if stale:
+            logger.info(f"Invalidated {len(stale)} cached answers")
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        bucket = self._buckets[entry.bucket]
+        bucket.remove(entry_id)
+        if not bucket:
+            del self._buckets[entry.bucket]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self._entries)
+        }
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """Return the process-wide answer cache shared by all sessions."""
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache()
+        return _answer_cache
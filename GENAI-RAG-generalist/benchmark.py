@@ -0,0 +1,223 @@
+"""Offline retrieval benchmark for VectorStore.
+
+Builds a corpus (synthetic, or the text files of a sample directory), then
+for every index backend / encoder backend combination measures ingestion
+throughput, query latency percentiles, dense recall@k against exact search
+and memory use. Results are written as JSON so releases can be compared.
+
+    python benchmark.py --backends flat,ivf_flat,hnsw --encoders torch,onnx --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+import faiss
+import numpy as np
+from document_processor import split_into_chunks
+from embedding_cache import EmbeddingCache
+from encoders import load_encoder
+from index_backends import ManagedIndex
+from vector_store import VectorStore, EMBEDDING_MODEL
+
+SAMPLE_EXTENSIONS = ('.txt', '.md', '.csv', '.html')
+
+
+def synthetic_corpus(documents: int, chunks_per_document: int, seed: int) -> List[List[str]]:
+    """Generate documents of topical chunks from a fixed random vocabulary."""
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                  for _ in range(5000)]
+    corpus = []
+    for _ in range(documents):
+        # Each document draws most of its words from its own topic
+        topic = rng.sample(vocabulary, 60)
+        chunks = []
+        for _ in range(chunks_per_document):
+            words = [rng.choice(topic) if rng.random() < 0.7 else rng.choice(vocabulary)
+                     for _ in range(rng.randint(40, 120))]
+            chunks.append(' '.join(words) + '.')
+        corpus.append(chunks)
+    return corpus
+
+
+def sample_corpus(directory: str) -> List[List[str]]:
+    """Chunk every text file of a directory the way uploads are chunked."""
+    corpus = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(SAMPLE_EXTENSIONS):
+                with open(os.path.join(root, name), encoding='utf-8', errors='ignore') as f:
+                    chunks = split_into_chunks(f.read())
+                if chunks:
+                    corpus.append(chunks)
+    return corpus
+
+
+def make_queries(corpus: List[List[str]], count: int, seed: int) -> List[str]:
+    """Build queries from word windows of random chunks."""
+    rng = random.Random(seed + 1)
+    chunks = [chunk for document in corpus for chunk in document]
+    queries = []
+    for _ in range(count):
+        words = rng.choice(chunks).split()
+        start = rng.randrange(max(1, len(words) - 8))
+        queries.append(' '.join(words[start:start + 8]))
+    return queries
+
+
+def resident_memory() -> int:
+    """Current resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    # Peak rather than current RSS where /proc is unavailable (kilobytes on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    values = np.asarray(samples) * 1000
+    return {
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'mean': float(values.mean())
+    }
+
+
+def dense_recall(store: VectorStore, queries: List[str], k: int, **search_params) -> float:
+    """Share of the exact top k (brute force over stored embeddings) the index returns."""
+    embeddings = store._encode_queries(queries)
+    _, found = store.index.search(embeddings, k, **search_params)
+    scores = embeddings @ store.embeddings.matrix().T
+    exact = np.argsort(-scores, axis=1)[:, :k]
+    hits = sum(len(set(found[i][found[i] >= 0]) & set(exact[i])) for i in range(len(queries)))
+    return hits / exact.size
+
+
+def run_configuration(corpus: List[List[str]], queries: List[str], backend: str, encoder_name: str,
+                      k: int, concurrency: int, search_params: Dict) -> Dict[str, any]:
+    encoder = load_encoder(EMBEDDING_MODEL, encoder_name)
+    # No cache entries survive, every configuration pays for its own encoding
+    store = VectorStore(encoder=encoder, index_backend=backend,
+                        embedding_cache=EmbeddingCache(EMBEDDING_MODEL, max_items=0))
+    total_chunks = sum(len(document) for document in corpus)
+    # Promote once, when the whole corpus is in, like a store that outgrew the flat index
+    # (not on its own: repeated chunks share rows, so the index may hold fewer than total_chunks)
+    store.index = ManagedIndex(store.dimension, backend=backend, promotion_threshold=total_chunks + 1)
+    rss_before = resident_memory()
+
+    started = time.perf_counter()
+    for i, chunks in enumerate(corpus):
+        store.add_documents(chunks, {'filename': f'doc-{i}', 'format': 'text/plain'})
+    ingest_seconds = time.perf_counter() - started
+    store.index.promote()
+    while store.index.is_promoting:
+        time.sleep(0.05)
+    build_seconds = time.perf_counter() - started - ingest_seconds
+    # A failed promotion stays flat; its numbers would be reported under the wrong backend
+    assert store.index.active_backend == backend, \
+        f"index is {store.index.active_backend}, not {backend}, after promotion (see the log)"
+
+    def timed_query(query: str) -> float:
+        query_started = time.perf_counter()
+        store.get_relevant_context(query, k=k, **search_params)
+        return time.perf_counter() - query_started
+
+    for query in queries[:5]:
+        timed_query(query)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(timed_query, queries))
+    query_seconds = time.perf_counter() - started
+
+    result = {
+        'backend': backend,
+        'active_backend': store.index.active_backend,
+        'encoder': encoder_name,
+        'documents': len(corpus),
+        'chunks': total_chunks,
+        'indexed_rows': store.index.ntotal,
+        'ingest_seconds': ingest_seconds,
+        'ingest_chunks_per_sec': total_chunks / ingest_seconds,
+        'embedding': store.embedding_batcher.stats(),
+        'index_build_seconds': build_seconds,
+        'queries': len(queries),
+        'concurrency': concurrency,
+        'queries_per_sec': len(queries) / query_seconds,
+        'query_latency_ms': percentiles(latencies),
+        f'recall_at_{k}': dense_recall(store, queries, k, **search_params),
+        'store_memory_bytes': store.memory_usage(),
+        'index_memory_bytes': store.index.memory_usage(),
+        'resident_memory_bytes': resident_memory(),
+        'resident_memory_delta_bytes': resident_memory() - rss_before
+    }
+    store.query_batcher.close()
+    return result
+
+
+def main(argv=None) -> Dict[str, any]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default='flat,ivf_flat,ivf_pq,hnsw')
+    parser.add_argument('--encoders', default='torch')
+    parser.add_argument('--documents', type=int, default=200)
+    parser.add_argument('--chunks-per-document', type=int, default=50)
+    parser.add_argument('--sample-dir', help='use the text files of this directory instead of a synthetic corpus')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--nprobe', type=int)
+    parser.add_argument('--ef-search', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.sample_dir:
+        corpus = sample_corpus(args.sample_dir)
+    else:
+        corpus = synthetic_corpus(args.documents, args.chunks_per_document, args.seed)
+    queries = make_queries(corpus, args.queries, args.seed)
+    search_params = {'nprobe': args.nprobe, 'ef_search': args.ef_search}
+
+    results = []
+    for encoder_name in args.encoders.split(','):
+        for backend in args.backends.split(','):
+            print(f"Benchmarking {backend} index with {encoder_name} encoder...", file=sys.stderr)
+            results.append(run_configuration(corpus, queries, backend, encoder_name,
+                                             args.k, args.concurrency, search_params))
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'model': EMBEDDING_MODEL,
+            'corpus': args.sample_dir or 'synthetic',
+            'python': platform.python_version(),
+            'faiss': faiss.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args)
+        },
+        'results': results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == '__main__':
+    main()
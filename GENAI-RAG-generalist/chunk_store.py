@@ -0,0 +1,219 @@
+import os
+import json
+from array import array
+from typing import Iterable, List, Dict, Optional
+import numpy as np
+
+__all__ = ['ChunkStore']
+
+DOCUMENTS_FILE = 'documents.json'
+TEXTS_FILE = 'texts.bin'
+TEXT_OFFSETS_FILE = 'text_offsets.npy'
+DOC_ROWS_FILE = 'doc_rows.npy'
+CHUNK_INDEX_FILE = 'chunk_index.npy'
+SOURCES_FILE = 'sources.json'
+
+
+class ChunkStore:
+    """Chunk text and metadata addressed by index row id.
+
+    Metadata is kept once per document plus two small integer columns per
+    chunk (document row and position in the document). A row shared by
+    duplicate chunks of other documents lists them as extra sources.
+    Chunks restored from a snapshot stay memory-mapped; chunks added
+    afterwards live in memory.
+    """
+
+    def __init__(self):
+        self.documents: List[Dict] = []
+        self._texts: List[str] = []
+        self._doc_rows = array('i')
+        self._chunk_index = array('i')
+        self._text_bytes = 0
+        # Row -> [document row, chunk index] of the duplicates it stands for
+        self.sources: Dict[int, List[List[int]]] = {}
+        # Memory-mapped segment restored from disk
+        self._base_count = 0
+        self._base_texts = None
+        self._base_offsets = None
+        self._base_doc_rows = None
+        self._base_chunk_index = None
+
+    def __len__(self) -> int:
+        return self._base_count + len(self._texts)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate bytes of chunk text and columns."""
+        base = 0
+        if self._base_count:
+            base = self._base_texts.nbytes + self._base_offsets.nbytes + self._base_doc_rows.nbytes \
+                + self._base_chunk_index.nbytes
+        return base + self._text_bytes + 8 * len(self._doc_rows) + 64 * len(self.sources)
+
+    def add(self, chunks: List[str], doc_metadata: Dict) -> int:
+        """Append the chunks of one document and return its document row."""
+        doc_row = self.add_document(doc_metadata)
+        self.extend(doc_row, chunks, range(len(chunks)))
+        return doc_row
+
+    def add_document(self, doc_metadata: Dict) -> int:
+        """Register a document without chunks yet and return its document row."""
+        self.documents.append(doc_metadata)
+        return len(self.documents) - 1
+
+    def extend(self, doc_row: int, chunks: List[str], chunk_indexes: Iterable[int]) -> None:
+        """Append more chunks of an already added document at the given positions in it."""
+        self._texts.extend(chunks)
+        self._text_bytes += sum(len(chunk) for chunk in chunks)
+        self._doc_rows.extend([doc_row] * len(chunks))
+        self._chunk_index.extend(chunk_indexes)
+
+    def add_source(self, row: int, doc_row: int, chunk_index: int) -> None:
+        """Record that chunk chunk_index of document doc_row repeats the text of row."""
+        self.sources.setdefault(row, []).append([doc_row, chunk_index])
+
+    def text(self, row: int) -> str:
+        if row < self._base_count:
+            start, end = self._base_offsets[row], self._base_offsets[row + 1]
+            return bytes(self._base_texts[start:end]).decode('utf-8')
+        return self._texts[row - self._base_count]
+
+    def doc_row(self, row: int) -> int:
+        if row < self._base_count:
+            return int(self._base_doc_rows[row])
+        return self._doc_rows[row - self._base_count]
+
+    def metadata(self, row: int, owner: Optional[str] = None) -> Optional[Dict]:
+        """Build the metadata dict for one chunk.
+
+        With owner, the chunk is described only by the documents owner may
+        see (the row may also stand for other owners' duplicates), and
+        None is returned when there are none. Documents shared with owner
+        carry the filename owner uploaded them under.
+        """
+        text = self.text(row)
+        if row < self._base_count:
+            chunk_index = int(self._base_chunk_index[row])
+        else:
+            chunk_index = self._chunk_index[row - self._base_count]
+        entries = [[self.doc_row(row), chunk_index]] + self.sources.get(row, [])
+        if owner is not None:
+            entries = [entry for entry in entries if self.visible_to(self.documents[entry[0]], owner)]
+            if not entries:
+                return None
+        doc_row, chunk_index = entries[0]
+        metadata = dict(self.documents[doc_row])
+        metadata.pop('shared_names', None)
+        metadata.pop('shared_with', None)
+        metadata['filename'] = self._filename(self.documents[doc_row], owner)
+        metadata.update({
+            'chunk_index': chunk_index,
+            'chunk_size': len(text),
+            'text': text
+        })
+        if len(entries) > 1:
+            metadata['sources'] = [self._source(doc_row, index, owner) for doc_row, index in entries]
+        return metadata
+
+    @staticmethod
+    def visible_to(document: Dict, owner: Optional[str]) -> bool:
+        """Whether owner added the document or had it shared (everything is visible without owner)."""
+        return owner is None or document.get('owner') == owner or owner in document.get('shared_with', ())
+
+    @staticmethod
+    def _filename(document: Dict, owner: Optional[str]) -> str:
+        if owner is None or document.get('owner') == owner:
+            return document.get('filename', 'Unknown')
+        # Never the name another owner uploaded it under
+        return (document.get('shared_names') or {}).get(owner, 'Unknown')
+
+    def _source(self, doc_row: int, chunk_index: int, owner: Optional[str] = None) -> Dict:
+        document = self.documents[doc_row]
+        return {
+            'document_id': document.get('document_id'),
+            'filename': self._filename(document, owner),
+            'chunk_index': chunk_index
+        }
+
+    def documents_visible_to(self, owner: Optional[str]) -> List[int]:
+        """Rows of the documents owner added or had shared."""
+        return [i for i, document in enumerate(self.documents) if self.visible_to(document, owner)]
+
+    def rows_for_documents(self, doc_rows: List[int]) -> np.ndarray:
+        """Return the chunk rows of the given documents.
+
+        That is the rows of their own chunks and the rows standing in for
+        duplicate chunks of theirs; describe the latter with
+        metadata(row, owner) so the other documents they stand for stay hidden.
+        """
+        if not doc_rows:
+            return np.empty(0, dtype='int64')
+        columns = [np.frombuffer(self._doc_rows, dtype='int32')]
+        if self._base_count:
+            columns.insert(0, self._base_doc_rows)
+        all_rows = np.concatenate(columns)
+        rows = np.flatnonzero(np.isin(all_rows, doc_rows)).astype('int64')
+        wanted = set(doc_rows)
+        # Rows standing in for duplicate chunks of these documents
+        shared = [row for row, sources in self.sources.items()
+                  if any(doc_row in wanted for doc_row, _ in sources)]
+        if shared:
+            rows = np.union1d(rows, np.asarray(shared, dtype='int64'))
+        return rows
+
+    def save(self, path: str) -> None:
+        """Write documents, texts and columns to a directory."""
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, DOCUMENTS_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.documents, f, default=str)
+
+        offsets = np.empty(len(self) + 1, dtype='int64')
+        offsets[0] = 0
+        with open(os.path.join(path, TEXTS_FILE), 'wb') as f:
+            position = 0
+            if self._base_count:
+                f.write(memoryview(self._base_texts))
+                offsets[:self._base_count + 1] = self._base_offsets
+                position = int(self._base_offsets[-1])
+            for i, text in enumerate(self._texts, start=self._base_count + 1):
+                encoded = text.encode('utf-8')
+                f.write(encoded)
+                position += len(encoded)
+                offsets[i] = position
+        np.save(os.path.join(path, TEXT_OFFSETS_FILE), offsets)
+
+        doc_rows = np.frombuffer(self._doc_rows, dtype='int32')
+        chunk_index = np.frombuffer(self._chunk_index, dtype='int32')
+        if self._base_count:
+            doc_rows = np.concatenate([self._base_doc_rows, doc_rows])
+            chunk_index = np.concatenate([self._base_chunk_index, chunk_index])
+        np.save(os.path.join(path, DOC_ROWS_FILE), doc_rows)
+        np.save(os.path.join(path, CHUNK_INDEX_FILE), chunk_index)
+        with open(os.path.join(path, SOURCES_FILE), 'w') as f:
+            json.dump({str(row): sources for row, sources in self.sources.items()}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'ChunkStore':
+        """Restore a ChunkStore saved with save(), memory-mapping the columns."""
+        store = cls()
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(path, DOCUMENTS_FILE), encoding='utf-8') as f:
+            store.documents = json.load(f)
+        store._base_offsets = np.load(os.path.join(path, TEXT_OFFSETS_FILE), mmap_mode=mmap_mode)
+        store._base_doc_rows = np.load(os.path.join(path, DOC_ROWS_FILE), mmap_mode=mmap_mode)
+        store._base_chunk_index = np.load(os.path.join(path, CHUNK_INDEX_FILE), mmap_mode=mmap_mode)
+        store._base_count = len(store._base_doc_rows)
+        sources_path = os.path.join(path, SOURCES_FILE)
+        if os.path.exists(sources_path):
+            with open(sources_path) as f:
+                store.sources = {int(row): sources for row, sources in json.load(f).items()}
+
+        texts_path = os.path.join(path, TEXTS_FILE)
+        if os.path.getsize(texts_path):
+            store._base_texts = np.memmap(texts_path, dtype='uint8', mode='r') if mmap \
+                else np.fromfile(texts_path, dtype='uint8')
+        else:
+            # np.memmap cannot map an empty file
+            store._base_texts = np.empty(0, dtype='uint8')
+        return store
@@ -0,0 +1,120 @@
+import os
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+__all__ = ['pack_context', 'source_header', 'get_token_counter']
+
+logger = logging.getLogger(__name__)
+
+# Prompt tokens given to retrieved context at most
+CONTEXT_MAX_TOKENS = int(os.environ.get('CONTEXT_MAX_TOKENS', 1500))
+# Chunks less similar (cosine) to the question than this are left out of the prompt
+CONTEXT_MIN_SIMILARITY = float(os.environ.get('CONTEXT_MIN_SIMILARITY', 0.2))
+# tiktoken encoding of the assistant's model
+CONTEXT_TOKEN_ENCODING = os.environ.get('CONTEXT_TOKEN_ENCODING', 'o200k_base')
+# Rough characters per token when tiktoken is not available
+CHARS_PER_TOKEN = 4
+
+BLOCK_SEPARATOR = "\n\n"
+
+
+def source_header(metadata: Dict) -> str:
+    """The "From ..." line naming the documents a chunk appeared in."""
+    # A collapsed duplicate names every document it appeared in
+    filenames = list(dict.fromkeys(source['filename'] for source in metadata['sources'])) \
+        if 'sources' in metadata else [metadata.get('filename', 'Unknown')]
+    return f"From {', '.join(str(name) for name in filenames)}:"
+
+
+@dataclass
+class _Block:
+    """Consecutive chunks of one document, given to the assistant under one header."""
+    header: str
+    rank: int
+    chunks: List[Tuple[int, Dict]] = field(default_factory=list)
+
+    def text(self) -> str:
+        body = ' '.join(metadata['text'] for _, metadata in sorted(self.chunks, key=lambda c: c[0]))
+        return f"{self.header}\n{body}"
+
+
+def pack_context(candidates: List[Tuple[float, Dict]], max_tokens: int = CONTEXT_MAX_TOKENS,
+                 min_similarity: float = CONTEXT_MIN_SIMILARITY,
+                 count_tokens: Optional[Callable[[str], int]] = None) -> Tuple[str, List[Dict], Dict]:
+    """Assemble the prompt context from ranked (similarity, chunk metadata) candidates.
+
+    Chunks under min_similarity are dropped. The rest are taken in rank
+    order while they fit in max_tokens; a chunk that does not fit is
+    skipped for smaller ones. Chunks that follow each other in the same
+    document are merged under one header. Returns the context, the
+    metadata of the chunks in it and token counts for logging.
+    """
+    count_tokens = count_tokens or get_token_counter()
+    # What the whole candidate list used to cost, one header per chunk
+    baseline = count_tokens(BLOCK_SEPARATOR.join(
+        f"{source_header(metadata)}\n{metadata['text']}" for _, metadata in candidates))
+
+    blocks: List[_Block] = []
+    # (document, chunk_index) -> block holding that chunk
+    positions: Dict[Tuple, _Block] = {}
+    used = 0
+    selected: List[Dict] = []
+    for rank, (similarity, metadata) in enumerate(candidates):
+        if similarity < min_similarity:
+            continue
+        document = metadata.get('document_id') or metadata.get('filename')
+        chunk_index = metadata.get('chunk_index', 0)
+        block = positions.get((document, chunk_index - 1)) or positions.get((document, chunk_index + 1))
+        if block is not None:
+            # Joins a neighbour's block: only its text is added
+            cost = count_tokens(f" {metadata['text']}")
+        else:
+            cost = count_tokens(f"{source_header(metadata)}\n{metadata['text']}") \
+                + (count_tokens(BLOCK_SEPARATOR) if blocks else 0)
+        if used + cost > max_tokens:
+            continue
+        used += cost
+        if block is None:
+            block = _Block(source_header(metadata), rank)
+            blocks.append(block)
+        block.chunks.append((chunk_index, metadata))
+        positions[(document, chunk_index)] = block
+        selected.append(metadata)
+
+    context = BLOCK_SEPARATOR.join(block.text() for block in sorted(blocks, key=lambda b: b.rank))
+    tokens = count_tokens(context) if context else 0
+    stats = {
+        'candidates': len(candidates),
+        'chunks': len(selected),
+        'blocks': len(blocks),
+        'tokens': tokens,
+        'baseline_tokens': baseline,
+        'tokens_saved': baseline - tokens
+    }
+    return context, selected, stats
+
+
+def load_token_counter() -> Callable[[str], int]:
+    """Count tokens with tiktoken, or estimate them from characters if it is not available."""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding(CONTEXT_TOKEN_ENCODING)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        logger.warning(f"tiktoken encoding {CONTEXT_TOKEN_ENCODING} unavailable, estimating tokens: {str(e)}")
+        return lambda text: len(text) // CHARS_PER_TOKEN + 1
+
+
+_token_counter = None
+_token_counter_lock = threading.Lock()
+
+
+def get_token_counter() -> Callable[[str], int]:
+    """Return the process-wide prompt token counter."""
+    global _token_counter
+    with _token_counter_lock:
+        if _token_counter is None:
+            _token_counter = load_token_counter()
+        return _token_counter
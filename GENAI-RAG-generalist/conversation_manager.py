@@ -1,9 +1,11 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import time
+import hashlib
 from datetime import datetime
 import uuid
 import logging
 from db_service import db_service
+from llm_interface import criar_thread
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +13,8 @@ class ConversationManager:
     def __init__(self, max_history: int = 10, session_expiry: int = 3600):
         self.max_history = max_history
         self.session_expiry = session_expiry  # Session expiry in seconds
+        # Assistant thread of each session: (API key fingerprint, thread id)
+        self._assistant_threads: Dict[str, Tuple[str, str]] = {}
 
     def create_session(self) -> str:
         """Create a new conversation session with clean state."""
@@ -66,6 +70,8 @@ class ConversationManager:
         """Clear the conversation history and document references for a session."""
         try:
             success = db_service.clear_conversation(session_id)
+            # The assistant would otherwise still see the cleared messages
+            self._assistant_threads.pop(session_id, None)
             if success:
                 # Reset session with a clean state message
                 db_service.store_conversation(session_id, {
@@ -82,6 +88,27 @@ class ConversationManager:
             logger.error(f"Error clearing conversation history: {str(e)}")
             return False
 
+    def assistant_thread(self, session_id: str, api_key: Optional[str] = None) -> Optional[str]:
+        """Get the assistant thread of a session, creating it on first use.
+
+        Every question of the session goes to this thread, so only the first
+        one pays for creating it. Threads belong to an API key, so a new one
+        is created when the key changes. Returns None if it cannot be
+        created; the question then gets a thread of its own.
+        """
+        fingerprint = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+        current = self._assistant_threads.get(session_id)
+        if current is not None and current[0] == fingerprint:
+            return current[1]
+        try:
+            thread_id = criar_thread(api_key)
+        except Exception as e:
+            logger.error(f"Error creating assistant thread: {str(e)}")
+            return None
+        self._assistant_threads[session_id] = (fingerprint, thread_id)
+        logger.info(f"Created assistant thread for session {session_id}")
+        return thread_id
+
     def get_session_info(self, session_id: str) -> Dict:
         """Get session information."""
         try:
@@ -1,8 +1,11 @@
 import os
 import logging
+import pickle
+import threading
 import uuid
 from datetime import datetime
 from typing import List, Dict, Optional, Set
+import utils
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -13,43 +16,53 @@ class InMemoryDBService:
         self.documents = {}
         self.conversations = {}
         self.chunks = {}
+        # Chunk ids of each document, so a document's chunks are found without a scan
+        self.document_chunks = {}
+        # SHA-256 of uploaded bytes -> ids of the documents indexed from them (one per shard)
+        self.content_hashes = {}
         self.logger = logging.getLogger(__name__)
+        # Ingestion threads write while the script thread reads and snapshots
+        self._lock = threading.RLock()
 
     def store_document(self, metadata: Dict) -> str:
         doc_id = str(uuid.uuid4())
         metadata['upload_time'] = datetime.now()
-        self.documents[doc_id] = metadata
+        with self._lock:
+            self.documents[doc_id] = metadata
         self.logger.info(f"Stored document with ID: {doc_id}")
         return doc_id
 
     def store_chunks(self, document_id: str, chunks: List[Dict]) -> List[str]:
         chunk_ids = []
-        for chunk in chunks:
-            chunk_id = str(uuid.uuid4())
-            chunk['document_id'] = document_id
-            chunk['created_at'] = datetime.now()
-            self.chunks[chunk_id] = chunk
-            chunk_ids.append(chunk_id)
+        with self._lock:
+            for chunk in chunks:
+                chunk_id = str(uuid.uuid4())
+                chunk['document_id'] = document_id
+                chunk['created_at'] = datetime.now()
+                self.chunks[chunk_id] = chunk
+                chunk_ids.append(chunk_id)
+            self.document_chunks.setdefault(document_id, []).extend(chunk_ids)
         self.logger.info(f"Stored {len(chunk_ids)} chunks for document {document_id}")
         return chunk_ids
 
     def store_conversation(self, session_id: str, message: Dict):
-        if session_id not in self.conversations:
-            self.conversations[session_id] = {
-                'messages': [],
-                'created_at': datetime.now().isoformat(),
-                'last_accessed': datetime.now().isoformat(),
-                'documents': set()
-            }
-        message['timestamp'] = datetime.now()
-        if doc_context := message.get('document_context', {}):
-            if 'filename' in doc_context:
-                self.conversations[session_id]['documents'].add(doc_context['filename'])
-            elif 'documents' in doc_context:
-                self.conversations[session_id]['documents'].update(doc_context.get('documents', []))
-        
-        self.conversations[session_id]['messages'].append(message)
-        self.conversations[session_id]['last_accessed'] = datetime.now().isoformat()
+        with self._lock:
+            if session_id not in self.conversations:
+                self.conversations[session_id] = {
+                    'messages': [],
+                    'created_at': datetime.now().isoformat(),
+                    'last_accessed': datetime.now().isoformat(),
+                    'documents': set()
+                }
+            message['timestamp'] = datetime.now()
+            if doc_context := message.get('document_context', {}):
+                if 'filename' in doc_context:
+                    self.conversations[session_id]['documents'].add(doc_context['filename'])
+                elif 'documents' in doc_context:
+                    self.conversations[session_id]['documents'].update(doc_context.get('documents', []))
+
+            self.conversations[session_id]['messages'].append(message)
+            self.conversations[session_id]['last_accessed'] = datetime.now().isoformat()
         self.logger.info(f"Stored conversation message for session {session_id}")
 
     def get_conversation_history(self, session_id: str) -> List[Dict]:
@@ -61,20 +74,21 @@ class InMemoryDBService:
     def clear_conversation(self, session_id: str) -> bool:
         """Clear the conversation history and document references for a session."""
         try:
-            if session_id in self.conversations:
-                # Preserve session metadata but clear messages and documents
-                created_at = self.conversations[session_id].get('created_at')
-                self.conversations[session_id] = {
-                    'messages': [],
-                    'created_at': created_at,
-                    'last_accessed': datetime.now().isoformat(),
-                    'documents': set()
-                }
-                self.logger.info(f"Cleared conversation history and documents for session {session_id}")
-                return True
-            else:
-                self.logger.warning(f"No conversation found for session {session_id}")
-                return False
+            with self._lock:
+                if session_id in self.conversations:
+                    # Preserve session metadata but clear messages and documents
+                    created_at = self.conversations[session_id].get('created_at')
+                    self.conversations[session_id] = {
+                        'messages': [],
+                        'created_at': created_at,
+                        'last_accessed': datetime.now().isoformat(),
+                        'documents': set()
+                    }
+                    self.logger.info(f"Cleared conversation history and documents for session {session_id}")
+                    return True
+                else:
+                    self.logger.warning(f"No conversation found for session {session_id}")
+                    return False
         except Exception as e:
             self.logger.error(f"Error clearing conversation: {str(e)}")
             return False
@@ -83,21 +97,25 @@ class InMemoryDBService:
         """Remove expired conversation sessions."""
         expiry_time = datetime.now().timestamp() - (expiry_hours * 3600)
         expired_sessions = []
-        for session_id, session in self.conversations.items():
-            last_message = session['messages'][-1] if session['messages'] else None
-            if last_message and last_message['timestamp'].timestamp() < expiry_time:
-                expired_sessions.append(session_id)
-        
-        for session_id in expired_sessions:
-            del self.conversations[session_id]
+        with self._lock:
+            for session_id, session in self.conversations.items():
+                last_message = session['messages'][-1] if session['messages'] else None
+                if last_message and last_message['timestamp'].timestamp() < expiry_time:
+                    expired_sessions.append(session_id)
+
+            for session_id in expired_sessions:
+                del self.conversations[session_id]
         self.logger.info(f"Cleaned up {len(expired_sessions)} expired sessions")
 
     def get_document_stats(self) -> Dict:
+        with self._lock:
+            documents = list(self.documents.values())
+            total_chunks = len(self.chunks)
         stats = {
-            'total_documents': len(self.documents),
-            'total_chunks': len(self.chunks),
-            'total_size': sum(doc.get('file_size', 0) for doc in self.documents.values()),
-            'formats': list(set(doc.get('format', '') for doc in self.documents.values()))
+            'total_documents': len(documents),
+            'total_chunks': total_chunks,
+            'total_size': sum(doc.get('file_size', 0) for doc in documents),
+            'formats': list(set(doc.get('format', '') for doc in documents))
         }
         self.logger.info("Retrieved document statistics successfully")
         return stats
@@ -106,7 +124,67 @@ class InMemoryDBService:
         return self.documents.get(document_id)
 
     def get_chunks_by_document(self, document_id: str) -> List[Dict]:
-        return [chunk for chunk in self.chunks.values() if chunk['document_id'] == document_id]
+        with self._lock:
+            return [self.chunks[chunk_id] for chunk_id in self.document_chunks.get(document_id, [])]
+
+    def register_content_hash(self, content_hash: str, document_id: str) -> None:
+        """Record that document_id was indexed from bytes with this hash."""
+        with self._lock:
+            document_ids = self.content_hashes.setdefault(content_hash, [])
+            if document_id not in document_ids:
+                document_ids.append(document_id)
+
+    def find_documents_by_hash(self, content_hash: str) -> List[str]:
+        """Return the ids of documents indexed from bytes with this hash."""
+        with self._lock:
+            return list(self.content_hashes.get(content_hash, []))
+
+    def save(self, path: str) -> None:
+        """Snapshot documents, chunks and conversations to a file.
+
+        Copies are taken under the lock and written without it; records are
+        copied too, since ingestion still fills in metadata after storing it.
+        """
+        tmp_path = f"{path}.tmp"
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._lock:
+            state = {
+                'documents': {doc_id: dict(doc) for doc_id, doc in self.documents.items()},
+                'chunks': {chunk_id: dict(chunk) for chunk_id, chunk in self.chunks.items()},
+                'conversations': {
+                    session_id: dict(session, messages=list(session['messages']),
+                                     documents=set(session['documents']))
+                    for session_id, session in self.conversations.items()
+                },
+                'content_hashes': {digest: list(ids) for digest, ids in self.content_hashes.items()}
+            }
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.logger.info(f"Saved db snapshot to {path}")
+
+    def load(self, path: str) -> bool:
+        """Restore a snapshot written by save(). Returns False if there is none."""
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        document_chunks = {}
+        for chunk_id, chunk in state.get('chunks', {}).items():
+            document_chunks.setdefault(chunk['document_id'], []).append(chunk_id)
+        with self._lock:
+            self.documents = state.get('documents', {})
+            self.chunks = state.get('chunks', {})
+            self.conversations = state.get('conversations', {})
+            self.content_hashes = state.get('content_hashes', {})
+            self.document_chunks = document_chunks
+        self.logger.info(f"Loaded db snapshot from {path} with {len(self.documents)} documents")
+        return True
 
 # Create a singleton instance
 db_service = InMemoryDBService()
+if utils.db_snapshot_path():
+    try:
+        db_service.load(utils.db_snapshot_path())
+    except Exception as e:
+        logger.error(f"Error restoring db snapshot, starting empty: {str(e)}")
@@ -1,86 +1,239 @@
 import io
-from typing import List, Dict, Tuple
-import utils
-from PyPDF2 import PdfReader
-from bs4 import BeautifulSoup
-from docx import Document
+import os
+import csv
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Callable, List, Dict, Tuple, Iterable, Iterator, Union
+from chunking import get_chunker, sanitize
+from uploads import SpooledUpload, UploadedBytes, open_upload, upload_path
+
+# Processes extracting PDF pages in parallel
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', os.cpu_count() or 1))
+# Smaller PDFs are extracted in-process, a pool costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 32))
+PDF_PAGES_PER_TASK = 8
+# Characters of a CSV upload inspected to detect its delimiter
+CSV_SNIFF_SIZE = 64 * 1024
+# Characters of a plain text upload decoded and chunked at a time
+TEXT_BLOCK_SIZE = 1024 * 1024
+# 'lxml' parses HTML in C; 'html.parser' is the pure-Python parser of the standard library
+HTML_PARSER = os.environ.get('HTML_PARSER', 'lxml')
+
+@dataclass
+class Extractor:
+    """Turns an uploaded file into text.
+
+    extract(uploaded_file, metadata) sets format metadata and returns an
+    iterable of text pieces (pages, paragraphs) to be chunked, or of
+    finished chunks when chunked is True. Parser libraries are imported
+    inside extract, so a format's parser is loaded the first time a file of
+    that format arrives.
+    """
+    extract: Callable[..., Iterable[str]]
+    chunked: bool = False
+
+# MIME type -> extractor
+_extractors: Dict[str, Extractor] = {}
+
+def register_extractor(mime_types: Iterable[str], extract: Callable[..., Iterable[str]],
+                       chunked: bool = False) -> None:
+    """Handle uploads of the given MIME types with extract (see Extractor)."""
+    for mime_type in mime_types:
+        _extractors[mime_type] = Extractor(extract, chunked)
+
+def extractor_for(mime_type: str) -> Extractor:
+    extractor = _extractors.get(mime_type)
+    if extractor is None:
+        raise ValueError("Unsupported file type")
+    return extractor
 
 def process_document(uploaded_file) -> Tuple[List[str], Dict]:
     """Process uploaded document and return chunks with metadata."""
+    chunks, metadata = stream_document(uploaded_file)
+    return list(chunks), metadata
+
+def parse_upload(name: str, size: int, type: str, source: Union[str, bytes]) -> Tuple[List[str], Dict]:
+    """Parse in a worker an upload sent as the path of its spool file or as its bytes.
+
+    Lives here so extraction workers import the parsers only, not the
+    vector store and db_service behind ingestion.
+    """
+    if isinstance(source, str):
+        return process_document(SpooledUpload(name, size, type, source, owned=False))
+    return process_document(UploadedBytes(name, size, type, source))
+
+def stream_document(uploaded_file) -> Tuple[Iterator[str], Dict]:
+    """Return a generator of the document's chunks and its metadata.
+
+    Chunks are produced while the document is being extracted. Metadata
+    that depends on the whole text (e.g. 'size') is filled in once the
+    generator is exhausted.
+    """
     try:
-        content = ""
         metadata = {
             'filename': uploaded_file.name,
             'file_size': uploaded_file.size,
             'upload_time': None  # Will be set by db_service
         }
         
-        if uploaded_file.type == "application/pdf":
-            content, pdf_meta = process_pdf(uploaded_file)
-            metadata.update(pdf_meta)
-        elif uploaded_file.type == "text/plain":
-            content = uploaded_file.getvalue().decode("utf-8")
-        elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            content, docx_meta = process_docx(uploaded_file)
-            metadata.update(docx_meta)
-        elif uploaded_file.type == "text/html":
-            content = process_html(uploaded_file)
-        elif uploaded_file.type in ["text/csv", "application/csv"]:
-            content, csv_meta = process_csv(uploaded_file)
-            metadata.update(csv_meta)
-        else:
-            raise ValueError("Unsupported file type")
+        extractor = extractor_for(uploaded_file.type)
+        pieces = extractor.extract(uploaded_file, metadata)
+        if extractor.chunked:
+            return _checked(pieces), metadata
         
-        # Clean and chunk the content
-        content = utils.sanitize_text(content)
-        chunks = split_into_chunks(content)
-        
-        return chunks, metadata
+        return _checked(iter_chunks(pieces)), metadata
         
     except Exception as e:
         raise ValueError(f"Error processing document: {str(e)}")
 
-def process_pdf(file) -> Tuple[str, Dict]:
-    """Extract text and metadata from PDF file."""
+def _checked(chunks: Iterator[str]) -> Iterator[str]:
     try:
-        pdf = PdfReader(io.BytesIO(file.getvalue()))
-        content = ""
-        for page in pdf.pages:
-            content += page.extract_text() + "\n"
-            
-        metadata = {
+        yield from chunks
+    except Exception as e:
+        raise ValueError(f"Error processing document: {str(e)}")
+
+def stream_pdf(file, metadata: Dict) -> Iterator[str]:
+    """Set PDF metadata and return a generator of page texts, in page order."""
+    stream = open_upload(file)
+    try:
+        from PyPDF2 import PdfReader
+        # Objects are read from the stream as pages are extracted
+        pdf = PdfReader(stream)
+        metadata.update({
             'format': 'pdf',
-            'pages': len(pdf.pages),
-            'size': len(content)
-        }
-        
-        return content, metadata
-        
+            'pages': len(pdf.pages)
+        })
     except Exception as e:
+        stream.close()
         raise ValueError(f"Error processing PDF: {str(e)}")
+    return _sized(_extract_pdf(file, stream, pdf), metadata)
+
+def _extract_pdf(file, stream, pdf) -> Iterator[str]:
+    with stream:
+        n_pages = len(pdf.pages)
+        # Inside a pool worker the file is already one of several parsed in parallel
+        if n_pages < PDF_PARALLEL_MIN_PAGES or EXTRACT_WORKERS < 2 or _in_worker:
+            for page in pdf.pages:
+                yield page.extract_text() or ""
+            return
+        
+        # Workers read the file from disk instead of receiving a copy with every task
+        with upload_path(file, suffix='.pdf') as path:
+            ranges = [(path, start, min(start + PDF_PAGES_PER_TASK, n_pages))
+                      for start in range(0, n_pages, PDF_PAGES_PER_TASK)]
+            try:
+                # map() yields in page order while later ranges are still being extracted
+                for pages in extraction_pool().map(_extract_pdf_pages, ranges):
+                    yield from pages
+            except BrokenProcessPool:
+                reset_extraction_pool()
+                raise
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def extraction_pool() -> ProcessPoolExecutor:
+    """Process pool shared by all extractions, started on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned rather than forked: the app process runs threads (Streamlit, FAISS)
+            _pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker)
+        return _pool
+
+def reset_extraction_pool() -> None:
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+_in_worker = False
 
-def process_docx(file) -> Tuple[str, Dict]:
-    """Extract text and metadata from DOCX file."""
+def _init_worker() -> None:
+    global _in_worker
+    _in_worker = True
+
+# Parsed PDF (path, open file, reader) kept by each worker between tasks of the same file
+_worker_pdf = (None, None, None)
+
+def _extract_pdf_pages(task: Tuple[str, int, int]) -> List[str]:
+    global _worker_pdf
+    from PyPDF2 import PdfReader
+    path, start, end = task
+    if _worker_pdf[0] != path:
+        if _worker_pdf[1] is not None:
+            _worker_pdf[1].close()
+        # A reader given a path would load the whole file into memory, one given a file reads it as needed
+        f = open(path, 'rb')
+        _worker_pdf = (path, f, PdfReader(f))
+    pdf = _worker_pdf[2]
+    return [pdf.pages[i].extract_text() or "" for i in range(start, end)]
+
+def stream_docx(file, metadata: Dict) -> Iterator[str]:
+    """Set DOCX metadata and return a generator of paragraph texts."""
     try:
-        doc = Document(io.BytesIO(file.getvalue()))
-        content = ""
-        for para in doc.paragraphs:
-            content += para.text + "\n"
-            
-        metadata = {
+        from docx import Document
+        with open_upload(file) as stream:
+            doc = Document(stream)
+        metadata.update({
             'format': 'docx',
-            'paragraphs': len(doc.paragraphs),
-            'size': len(content)
-        }
-        
-        return content, metadata
-        
+            'paragraphs': len(doc.paragraphs)
+        })
     except Exception as e:
         raise ValueError(f"Error processing DOCX: {str(e)}")
+    return _sized((para.text for para in doc.paragraphs), metadata)
+
+def _sized(pieces: Iterable[str], metadata: Dict) -> Iterator[str]:
+    """Pass pieces through, recording their total length (newline-joined) as metadata['size']."""
+    size = 0
+    for piece in pieces:
+        size += len(piece) + 1
+        yield piece
+    metadata['size'] = size
+
+def stream_text(file, metadata: Dict) -> Iterator[str]:
+    """Return a generator of the text of a plain text file, decoded a block at a time."""
+    return _read_text(file)
+
+def _read_text(file) -> Iterator[str]:
+    """Text in blocks of about TEXT_BLOCK_SIZE characters, each ending at whitespace.
+
+    The chunker joins pieces with a space, so a block cut inside a word
+    would split it; the trailing partial word goes to the next block.
+    """
+    partial = ''
+    with io.TextIOWrapper(open_upload(file), encoding='utf-8') as text:
+        for block in iter(lambda: text.read(TEXT_BLOCK_SIZE), ''):
+            block = partial + block
+            cut = len(block)
+            while cut and not block[cut - 1].isspace():
+                cut -= 1
+            if not cut:
+                # No whitespace at all: nothing better to cut at
+                partial = ''
+                yield block
+                continue
+            partial = block[cut:]
+            yield block[:cut]
+    if partial:
+        yield partial
+
+def stream_html(file, metadata: Dict) -> Iterator[str]:
+    """Return the text of an HTML file."""
+    return [process_html(file)]
 
 def process_html(file) -> str:
     """Extract text from HTML file."""
+    if HTML_PARSER == 'lxml':
+        try:
+            return _lxml_text(file)
+        except ImportError:
+            pass
     html_content = file.getvalue().decode("utf-8")
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html_content, 'html.parser')
     # Remove script and style elements
     for script in soup(["script", "style"]):
@@ -88,38 +241,76 @@ def process_html(file) -> str:
     text = soup.get_text(separator=" ")
     return text
 
-def process_csv(file) -> Tuple[str, Dict]:
-    """Extract text and metadata from CSV file."""
+def _lxml_text(file) -> str:
+    """Same text as BeautifulSoup's get_text(separator=" ") without script and style, parsed by lxml."""
+    import lxml.etree
+    import lxml.html
+    # lxml decodes and parses the upload stream directly, without a decoded copy of the file
+    with open_upload(file) as stream:
+        try:
+            root = lxml.html.parse(stream, lxml.html.HTMLParser(encoding='utf-8')).getroot()
+        except lxml.etree.ParserError:
+            # Empty document
+            return ""
+    if root is None:
+        return ""
+    for element in root.xpath('//script | //style'):
+        element.drop_tree()
+    return " ".join(root.itertext())
+
+def stream_csv(file, metadata: Dict) -> Iterator[str]:
+    """Set CSV metadata and return a generator of chunks of rows, each repeating the header row.
+
+    Rows are read from the upload stream as they are chunked, the file is
+    never decoded as a whole. 'rows' and 'size' are set once the generator
+    is exhausted.
+    """
+    metadata['format'] = 'csv'
+    return _csv_chunks(file, metadata)
+
+def _csv_chunks(file, metadata: Dict) -> Iterator[str]:
+    text = io.TextIOWrapper(open_upload(file), encoding='utf-8-sig', newline='')
     try:
-        # Read the CSV as text
-        content = file.getvalue().decode("utf-8")
-        
-        # Create metadata
-        metadata = {
-            'format': 'csv',
-            'rows': content.count('\n') + 1,
-            'size': len(content)
-        }
-        
-        return content, metadata
-        
-    except Exception as e:
+        sample = text.read(CSV_SNIFF_SIZE)
+        text.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(text, dialect)
+        header = next(reader, None)
+        if header is None:
+            metadata.update({'rows': 0, 'size': 0})
+            return
+        counts = {'rows': 1, 'size': sum(len(cell) + 1 for cell in header)}
+
+        def rows() -> Iterator[str]:
+            for row in reader:
+                counts['rows'] += 1
+                counts['size'] += sum(len(cell) + 1 for cell in row)
+                line = sanitize(', '.join(row))
+                if line:
+                    yield line
+
+        metadata['columns'] = header
+        yield from get_chunker().iter_rows(sanitize(', '.join(header)), rows())
+        metadata.update(counts)
+    except (csv.Error, UnicodeDecodeError) as e:
         raise ValueError(f"Não foi possível processar o arquivo CSV: {str(e)}")
+    finally:
+        text.close()
 
 def split_into_chunks(text: str) -> List[str]:
-    """Split text into chunks of appropriate size."""
-    chunks = []
-    current_chunk = ""
-    
-    for sentence in utils.split_into_sentences(text):
-        if len(current_chunk) + len(sentence) <= utils.MAX_CHUNK_SIZE:
-            current_chunk += sentence + " "
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence + " "
-    
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    return chunks
\ No newline at end of file
+    """Sanitize text and split it into chunks of appropriate size."""
+    return get_chunker().chunk(text)
+
+def iter_chunks(pieces: Iterable[str]) -> Iterator[str]:
+    """Sanitize and chunk text arriving in pieces (pages, paragraphs) without joining it first."""
+    return get_chunker().iter_chunks(pieces)
+
+register_extractor(["application/pdf"], stream_pdf)
+register_extractor(["text/plain"], stream_text)
+register_extractor(["application/vnd.openxmlformats-officedocument.wordprocessingml.document"], stream_docx)
+register_extractor(["text/html"], stream_html)
+# Rows are grouped into chunks directly, sentence splitting does not suit tables
+register_extractor(["text/csv", "application/csv"], stream_csv, chunked=True)
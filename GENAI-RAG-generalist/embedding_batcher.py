@@ -0,0 +1,110 @@
+import os
+import time
+import logging
+import threading
+from typing import Dict, List
+import numpy as np
+from encoders import Encoder
+
+__all__ = ['EmbeddingBatcher']
+
+logger = logging.getLogger(__name__)
+
+# Padded tokens per encoder call (batch size x longest chunk in the batch); short chunks
+# get large batches, long ones small batches that stay in CPU cache
+EMBED_BATCH_TOKENS = int(os.environ.get('EMBED_BATCH_TOKENS', 8192))
+# Upper bound on chunks per encoder call whatever their length
+EMBED_MAX_BATCH = int(os.environ.get('EMBED_MAX_BATCH', 128))
+# Rough characters per token when the encoder has no tokenizer to count with
+CHARS_PER_TOKEN = 4
+
+
+class EmbeddingBatcher:
+    """Encodes chunks in batches of similar length.
+
+    Chunks are sorted by token length and cut into batches whose padded
+    size stays under max_batch_tokens, so a batch of short chunks is not
+    padded to the length of one long chunk. Embeddings are returned in the
+    order of the input. Throughput is tracked for stats().
+    """
+
+    def __init__(self, encoder: Encoder, max_batch_tokens: int = EMBED_BATCH_TOKENS,
+                 max_batch: int = EMBED_MAX_BATCH):
+        self.encoder = encoder
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch = max_batch
+        self.tokenizer = getattr(encoder, 'tokenizer', None)
+        self.max_seq_length = getattr(encoder, 'max_seq_length', None)
+        self._lock = threading.Lock()
+        self._chunks = 0
+        self._batches = 0
+        self._seconds = 0.0
+        self._tokens = 0
+        self._padded_tokens = 0
+
+    def lengths(self, texts: List[str]) -> np.ndarray:
+        """Token length of each text as the encoder will see it."""
+        if self.tokenizer is not None:
+            try:
+                kwargs = {'truncation': True, 'max_length': self.max_seq_length} if self.max_seq_length else {}
+                lengths = np.array([len(ids) for ids in self.tokenizer(texts, **kwargs)['input_ids']])
+            except Exception as e:
+                logger.warning(f"Error counting tokens, estimating from characters: {str(e)}")
+                self.tokenizer = None
+        if self.tokenizer is None:
+            lengths = np.array([len(text) // CHARS_PER_TOKEN + 2 for text in texts])
+        if self.max_seq_length:
+            # The encoder truncates longer inputs
+            lengths = np.minimum(lengths, self.max_seq_length)
+        return lengths
+
+    def batches(self, lengths: np.ndarray) -> List[np.ndarray]:
+        """Input positions of each encoder call, shortest texts first."""
+        order = np.argsort(lengths, kind='stable')
+        batches = []
+        start = 0
+        for end in range(1, len(order) + 1):
+            # Sorted ascending, so the last text of a batch sets its padded length
+            if end < len(order) and end - start < self.max_batch \
+                    and (end + 1 - start) * lengths[order[end]] <= self.max_batch_tokens:
+                continue
+            batches.append(order[start:end])
+            start = end
+        return batches
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts, returning one row per text in input order."""
+        if not texts:
+            return np.empty((0, 0), dtype='float32')
+        started = time.perf_counter()
+        lengths = self.lengths(texts)
+        embeddings = None
+        padded = 0
+        batches = self.batches(lengths)
+        for positions in batches:
+            vectors = np.asarray(self.encoder.encode([texts[i] for i in positions], batch_size=len(positions)),
+                                 dtype='float32')
+            if embeddings is None:
+                embeddings = np.empty((len(texts), vectors.shape[1]), dtype='float32')
+            embeddings[positions] = vectors
+            padded += len(positions) * int(lengths[positions[-1]])
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._chunks += len(texts)
+            self._batches += len(batches)
+            self._seconds += elapsed
+            self._tokens += int(lengths.sum())
+            self._padded_tokens += padded
+        logger.info(f"Embedded {len(texts)} chunks in {len(batches)} batches, {len(texts) / elapsed:.1f} chunks/s")
+        return embeddings
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            return {
+                'chunks': self._chunks,
+                'batches': self._batches,
+                'seconds': self._seconds,
+                'chunks_per_sec': self._chunks / self._seconds if self._seconds else 0.0,
+                # Share of encoded positions that were real tokens rather than padding
+                'padding_efficiency': self._tokens / self._padded_tokens if self._padded_tokens else 1.0
+            }
@@ -0,0 +1,110 @@
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional
+import numpy as np
+
+__all__ = ['EmbeddingCache']
+
+logger = logging.getLogger(__name__)
+
+# Entries kept in memory (~1.5 KB each for a 384-dim float32 vector)
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', 20000))
+
+
+class EmbeddingCache:
+    """Content-addressed cache of text embeddings.
+
+    Keys hash the model name together with the text, so identical chunks
+    uploaded by any session cost a lookup instead of an encoder pass. A
+    size-bounded LRU sits in front of an optional SQLite file on disk.
+    """
+
+    def __init__(self, model_name: str, max_items: int = EMBEDDING_CACHE_SIZE, path: Optional[str] = None):
+        self.model_name = model_name
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, dtype TEXT, vector BLOB)"
+            )
+            self._db.commit()
+
+    def key(self, text: str) -> bytes:
+        return hashlib.blake2b(f"{self.model_name}\0{text}".encode('utf-8'), digest_size=16).digest()
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        return self._get(self.key(text))
+
+    def _get(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                return vector
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT dtype, vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        vector = np.frombuffer(row[1], dtype=row[0])
+        self._remember(key, vector)
+        return vector
+
+    def _remember(self, key: bytes, vector: np.ndarray) -> None:
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def put_many(self, keys: List[bytes], vectors: np.ndarray) -> None:
+        for key, vector in zip(keys, vectors):
+            self._remember(key, vector)
+        if self._db is not None:
+            with self._lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, dtype, vector) VALUES (?, ?, ?)",
+                    [(key, vector.dtype.str, vector.tobytes()) for key, vector in zip(keys, vectors)]
+                )
+                self._db.commit()
+
+    def encode(self, texts: List[str], encode_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Return embeddings for texts, calling encode_fn only for cache misses."""
+        keys = [self.key(text) for text in texts]
+        vectors: List[Optional[np.ndarray]] = [self._get(key) for key in keys]
+
+        # Encode each distinct missing text once, even if it repeats in this batch
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], []).append(i)
+        self.hits += len(texts) - sum(len(positions) for positions in missing.values())
+        self.misses += len(missing)
+
+        if missing:
+            missing_keys = list(missing)
+            encoded = np.asarray(encode_fn([texts[missing[key][0]] for key in missing_keys]), dtype='float32')
+            self.put_many(missing_keys, encoded)
+            for key, vector in zip(missing_keys, encoded):
+                for i in missing[key]:
+                    vectors[i] = vector
+        return np.vstack(vectors) if vectors else np.empty((0, 0), dtype='float32')
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'memory_items': len(self._memory)
+        }
@@ -0,0 +1,85 @@
+import os
+import sys
+from typing import Optional
+import numpy as np
+
+__all__ = ['EmbeddingStore', 'python_list_bytes']
+
+# float32 keeps full precision; float16 halves memory, int8 quarters it
+EMBEDDING_STORAGE_DTYPE = os.environ.get('EMBEDDING_STORAGE_DTYPE', 'float32')
+STORAGE_DTYPES = ('float32', 'float16', 'int8')
+# Normalized embeddings lie in [-1, 1]; int8 storage scales them to [-127, 127]
+INT8_SCALE = 127.0
+
+
+def python_list_bytes(dimension: int) -> int:
+    """Approximate memory of one embedding held as a Python list of floats."""
+    return sys.getsizeof([0.0] * dimension) + dimension * sys.getsizeof(1.0)
+
+
+class EmbeddingStore:
+    """Contiguous, growable matrix of normalized chunk embeddings.
+
+    Row n holds the embedding of index row n, so a chunk only needs to carry
+    its offset. Capacity grows geometrically to keep appends amortized O(1).
+    """
+
+    def __init__(self, dimension: int, dtype: Optional[str] = None):
+        self.dimension = dimension
+        self.dtype = dtype or EMBEDDING_STORAGE_DTYPE
+        if self.dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Unsupported embedding storage dtype: {self.dtype}")
+        self._data = np.empty((0, dimension), dtype=self.dtype)
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes used by stored embeddings (excluding spare capacity)."""
+        return self._count * self.dimension * np.dtype(self.dtype).itemsize
+
+    def append(self, vectors: np.ndarray) -> int:
+        """Store vectors and return the offset of the first one."""
+        vectors = np.asarray(vectors, dtype='float32').reshape(-1, self.dimension)
+        needed = self._count + len(vectors)
+        if needed > len(self._data) or not self._data.flags.writeable:
+            capacity = max(needed, 2 * len(self._data), 1024)
+            grown = np.empty((capacity, self.dimension), dtype=self.dtype)
+            grown[:self._count] = self._data[:self._count]
+            self._data = grown
+        offset = self._count
+        self._data[offset:needed] = self._encode(vectors)
+        self._count = needed
+        return offset
+
+    def get(self, offsets) -> np.ndarray:
+        """Return float32 embeddings for one or more offsets."""
+        return self._decode(self._data[offsets])
+
+    def matrix(self) -> np.ndarray:
+        """Return all stored embeddings as float32."""
+        return self._decode(self._data[:self._count])
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == 'int8':
+            return np.clip(np.round(vectors * INT8_SCALE), -127, 127).astype('int8')
+        return vectors.astype(self.dtype)
+
+    def _decode(self, stored: np.ndarray) -> np.ndarray:
+        if self.dtype == 'int8':
+            return stored.astype('float32') / INT8_SCALE
+        return stored.astype('float32')
+
+    def save(self, path: str) -> None:
+        np.save(path, self._data[:self._count])
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'EmbeddingStore':
+        """Load embeddings saved with save(); mapped read-only until the next append."""
+        data = np.load(path, mmap_mode='r' if mmap else None)
+        store = cls(data.shape[1], dtype=str(data.dtype))
+        store._data = data
+        store._count = len(data)
+        return store
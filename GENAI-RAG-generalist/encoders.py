@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import logging
+from typing import Dict, List, Optional, Protocol
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+__all__ = ['Encoder', 'load_encoder', 'load_checked_encoder', 'check_parity', 'ENCODER_BACKENDS']
+
+logger = logging.getLogger(__name__)
+
+# 'torch' runs the model on PyTorch; 'onnx' runs the exported graph on ONNX
+# Runtime; 'onnx_int8' runs a dynamically int8-quantized export of it.
+# The ONNX backends need optimum[onnxruntime] installed.
+ENCODER_BACKENDS = ('torch', 'onnx', 'onnx_int8')
+
+DEFAULT_ENCODER_BACKEND = os.environ.get('ENCODER_BACKEND', 'torch')
+# Quantized export shipped with the model on the Hugging Face Hub; pick the one matching the CPU
+# (model_qint8_avx2.onnx, model_qint8_avx512.onnx, model_qint8_avx512_vnni.onnx, model_qint8_arm64.onnx)
+ENCODER_ONNX_INT8_FILE = os.environ.get('ENCODER_ONNX_INT8_FILE', 'onnx/model_qint8_avx2.onnx')
+# Compare an accelerated backend against PyTorch when it is loaded, fall back to PyTorch on failure
+ENCODER_PARITY_CHECK = os.environ.get('ENCODER_PARITY_CHECK', 'true').lower() == 'true'
+# Lowest acceptable cosine similarity between a backend's embedding and the PyTorch one
+ENCODER_PARITY_MIN_COSINE = float(os.environ.get('ENCODER_PARITY_MIN_COSINE', 0.98))
+
+PARITY_SENTENCES = [
+    "How do I reset my password?",
+    "The pump must be replaced when the pressure drops below 2 bar.",
+    "Relatório trimestral de vendas da região sul.",
+    "Part XK-4471-B ships with firmware v2.3.1.",
+    "Quarterly revenue grew 12% compared to the same period last year, driven by new contracts.",
+    "a",
+]
+
+
+class Encoder(Protocol):
+    """What the vector store needs from an embedding model."""
+
+    def encode(self, sentences: List[str], **kwargs) -> np.ndarray:
+        ...
+
+
+def load_encoder(model_name: str, backend: Optional[str] = None) -> Encoder:
+    """Load model_name on the given encoder backend."""
+    backend = backend or DEFAULT_ENCODER_BACKEND
+    if backend == 'torch':
+        return SentenceTransformer(model_name)
+    if backend == 'onnx':
+        return SentenceTransformer(model_name, backend='onnx')
+    if backend == 'onnx_int8':
+        return SentenceTransformer(model_name, backend='onnx', model_kwargs={'file_name': ENCODER_ONNX_INT8_FILE})
+    raise ValueError(f"Unknown encoder backend: {backend}")
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype='float32')
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def check_parity(encoder: Encoder, reference: Encoder, sentences: Optional[List[str]] = None,
+                 min_cosine: float = ENCODER_PARITY_MIN_COSINE) -> Dict[str, any]:
+    """Compare an encoder's embeddings with a reference encoder's by cosine similarity."""
+    sentences = sentences or PARITY_SENTENCES
+    cosines = np.sum(_normalized(encoder.encode(sentences)) * _normalized(reference.encode(sentences)), axis=1)
+    return {
+        'sentences': len(sentences),
+        'min_cosine': float(cosines.min()),
+        'mean_cosine': float(cosines.mean()),
+        'min_allowed': min_cosine,
+        'passed': bool(cosines.min() >= min_cosine)
+    }
+
+
+def load_checked_encoder(model_name: str, backend: Optional[str] = None) -> Encoder:
+    """Load an encoder backend, falling back to PyTorch if it is unavailable or fails the parity check."""
+    backend = backend or DEFAULT_ENCODER_BACKEND
+    if backend == 'torch':
+        return load_encoder(model_name, 'torch')
+    try:
+        encoder = load_encoder(model_name, backend)
+    except Exception as e:
+        logger.error(f"Error loading {backend} encoder, using torch: {str(e)}")
+        return load_encoder(model_name, 'torch')
+    if ENCODER_PARITY_CHECK:
+        reference = load_encoder(model_name, 'torch')
+        parity = check_parity(encoder, reference)
+        if not parity['passed']:
+            logger.error(f"{backend} encoder failed the parity check, using torch: {parity}")
+            return reference
+        logger.info(f"{backend} encoder passed the parity check: {parity}")
+    return encoder
+
+
+if __name__ == '__main__':
+    # python encoders.py [model]: parity and speed of every backend against PyTorch
+    model = sys.argv[1] if len(sys.argv) > 1 else 'all-MiniLM-L6-v2'
+    texts = PARITY_SENTENCES * 32
+    reference = load_encoder(model, 'torch')
+    report = {}
+    for name in ENCODER_BACKENDS:
+        try:
+            encoder = reference if name == 'torch' else load_encoder(model, name)
+        except Exception as e:
+            report[name] = {'error': str(e)}
+            continue
+        encoder.encode(texts[:8])
+        started = time.perf_counter()
+        encoder.encode(texts)
+        elapsed = time.perf_counter() - started
+        report[name] = dict(check_parity(encoder, reference), sentences_per_sec=len(texts) / elapsed)
+    print(json.dumps(report, indent=2))
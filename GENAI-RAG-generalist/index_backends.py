@@ -0,0 +1,217 @@
+import os
+import logging
+import shutil
+import threading
+from typing import Optional, Tuple
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Supported index types. Every store starts on an exact flat index and is
+# promoted to the configured backend once it holds enough vectors to train it.
+INDEX_BACKENDS = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+
+DEFAULT_BACKEND = os.environ.get('VECTOR_INDEX_BACKEND', 'flat')
+PROMOTION_THRESHOLD = int(os.environ.get('VECTOR_INDEX_PROMOTION_THRESHOLD', 50000))
+DEFAULT_NPROBE = int(os.environ.get('VECTOR_INDEX_NPROBE', 16))
+DEFAULT_EF_SEARCH = int(os.environ.get('VECTOR_INDEX_EF_SEARCH', 64))
+# Ceiling for ef_search when it is raised for restricted searches
+MAX_EF_SEARCH = 4096
+HNSW_M = int(os.environ.get('VECTOR_INDEX_HNSW_M', 32))
+HNSW_EF_CONSTRUCTION = int(os.environ.get('VECTOR_INDEX_HNSW_EF_CONSTRUCTION', 80))
+PQ_SUBQUANTIZERS = int(os.environ.get('VECTOR_INDEX_PQ_M', 48))
+# Points sampled per IVF centroid for training (FAISS wants at least 39)
+TRAINING_POINTS_PER_LIST = 64
+
+
+def ivf_list_count(n_vectors: int) -> int:
+    """Pick the number of IVF inverted lists for a collection size."""
+    # ~4*sqrt(n) lists, but never so many that lists get too few training points
+    return int(max(16, min(65536, 4 * np.sqrt(n_vectors), n_vectors // 39)))
+
+
+def build_index(backend: str, dimension: int, n_vectors: int) -> faiss.Index:
+    """Create an empty (untrained) FAISS index for the given backend."""
+    if backend == 'flat':
+        return faiss.IndexFlatL2(dimension)
+    if backend == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return index
+
+    nlist = ivf_list_count(n_vectors)
+    quantizer = faiss.IndexFlatL2(dimension)
+    if backend == 'ivf_flat':
+        return faiss.IndexIVFFlat(quantizer, dimension, nlist)
+    if backend == 'ivf_pq':
+        if dimension % PQ_SUBQUANTIZERS:
+            raise ValueError(f"PQ sub-quantizers ({PQ_SUBQUANTIZERS}) must divide dimension {dimension}")
+        return faiss.IndexIVFPQ(quantizer, dimension, nlist, PQ_SUBQUANTIZERS, 8)
+    raise ValueError(f"Unsupported index backend: {backend}")
+
+
+def index_backend_name(index: faiss.Index) -> str:
+    """Map a FAISS index instance back to its backend name."""
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(index, faiss.IndexIVF):
+        return 'ivf_flat'
+    return 'flat'
+
+
+class ManagedIndex:
+    """FAISS index wrapper that starts flat and promotes itself in the background.
+
+    Row ids are positional: the n-th vector added always has id n, whichever
+    backend is currently serving, so callers can keep parallel arrays.
+    """
+
+    def __init__(self, dimension: int, backend: Optional[str] = None,
+                 promotion_threshold: Optional[int] = None):
+        self.dimension = dimension
+        self.backend = backend or DEFAULT_BACKEND
+        if self.backend not in INDEX_BACKENDS:
+            raise ValueError(f"Unsupported index backend: {self.backend}")
+        self.promotion_threshold = promotion_threshold or PROMOTION_THRESHOLD
+        self.index = faiss.IndexFlatL2(dimension)
+        self.active_backend = 'flat'
+        self._lock = threading.RLock()
+        self._promotion_thread = None
+        # Snapshot file backing read-only memory-mapped inverted lists, if any
+        self._mapped_from = None
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def memory_usage(self) -> int:
+        """Approximate bytes held by the active index."""
+        n = self.index.ntotal
+        if self.active_backend == 'ivf_pq':
+            return n * (PQ_SUBQUANTIZERS + 8)
+        if self.active_backend == 'hnsw':
+            return n * (self.dimension * 4 + HNSW_M * 2 * 4)
+        return n * self.dimension * 4
+
+    @property
+    def is_promoting(self) -> bool:
+        return self._promotion_thread is not None
+
+    def add(self, vectors: np.ndarray) -> int:
+        """Add vectors and return the row id of the first one."""
+        with self._lock:
+            if self._mapped_from:
+                # Memory-mapped IVF lists are read-only, load a writable copy first
+                self.index = faiss.read_index(self._mapped_from)
+                self._mapped_from = None
+            start = self.index.ntotal
+            self.index.add(vectors)
+            self._maybe_promote()
+        return start
+
+    def search(self, queries: np.ndarray, k: int, allowed_ids: Optional[np.ndarray] = None,
+               nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the active index, optionally restricted to allowed_ids.
+
+        nprobe (IVF) and ef_search (HNSW) tune the recall/latency trade-off per
+        query and are ignored by backends they do not apply to. With
+        allowed_ids they are raised in proportion to the share of rows
+        filtered out, so restricted searches still find k allowed rows.
+        """
+        with self._lock:
+            selector = None
+            if allowed_ids is not None:
+                selector = faiss.IDSelectorBatch(allowed_ids)
+                selectivity = min(1.0, max(1, allowed_ids.size) / max(1, self.index.ntotal))
+                nprobe, ef_search = self._scaled_effort(k, selectivity, nprobe, ef_search)
+            params = self._search_params(selector, nprobe, ef_search)
+            return self.index.search(queries, k, params=params)
+
+    def save(self, path: str) -> None:
+        """Write the active index to a file."""
+        with self._lock:
+            if self._mapped_from:
+                # Unchanged since load; the mapped index would reference its source file
+                shutil.copyfile(self._mapped_from, path)
+            else:
+                faiss.write_index(self.index, path)
+
+    @classmethod
+    def load(cls, path: str, backend: Optional[str] = None, promotion_threshold: Optional[int] = None,
+             mmap: bool = True) -> 'ManagedIndex':
+        """Load an index written by save(), memory-mapping it when possible."""
+        index = faiss.read_index(path, faiss.IO_FLAG_MMAP if mmap else 0)
+        managed = cls(index.d, backend=backend, promotion_threshold=promotion_threshold)
+        managed.index = index
+        managed.active_backend = index_backend_name(index)
+        if mmap and isinstance(index, faiss.IndexIVF):
+            managed._mapped_from = path
+        return managed
+
+    def _scaled_effort(self, k: int, selectivity: float, nprobe: Optional[int],
+                       ef_search: Optional[int]) -> Tuple[Optional[int], Optional[int]]:
+        if self.active_backend in ('ivf_flat', 'ivf_pq'):
+            nlist = self.index.nlist
+            nprobe = min(nlist, int(np.ceil((nprobe or DEFAULT_NPROBE) / selectivity)))
+        elif self.active_backend == 'hnsw':
+            ef_search = min(MAX_EF_SEARCH, int(np.ceil(max(ef_search or DEFAULT_EF_SEARCH, k) / selectivity)))
+        return nprobe, ef_search
+
+    def _search_params(self, selector, nprobe: Optional[int], ef_search: Optional[int]):
+        if self.active_backend in ('ivf_flat', 'ivf_pq'):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe or DEFAULT_NPROBE)
+        if self.active_backend == 'hnsw':
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search or DEFAULT_EF_SEARCH)
+        if selector is not None:
+            return faiss.SearchParameters(sel=selector)
+        return None
+
+    def promote(self) -> None:
+        """Start promoting to the configured backend now, however few vectors there are."""
+        with self._lock:
+            self.promotion_threshold = min(self.promotion_threshold, self.index.ntotal)
+            self._maybe_promote()
+
+    def _maybe_promote(self) -> None:
+        # Only flat indexes are promoted; a restored approximate index is kept as is
+        if self.active_backend != 'flat' or self.backend == 'flat' or self._promotion_thread is not None:
+            return
+        if self.index.ntotal < self.promotion_threshold:
+            return
+        self._promotion_thread = threading.Thread(
+            target=self._promote, name='faiss-index-promotion', daemon=True
+        )
+        self._promotion_thread.start()
+
+    def _promote(self) -> None:
+        """Build the target index from the flat vectors and swap it in."""
+        try:
+            with self._lock:
+                n = self.index.ntotal
+                vectors = self.index.reconstruct_n(0, n)
+            logger.info(f"Promoting index from flat to {self.backend} with {n} vectors")
+
+            # Training and bulk add happen without the lock so searches keep being served
+            target = build_index(self.backend, self.dimension, n)
+            if not target.is_trained:
+                sample_size = min(n, ivf_list_count(n) * TRAINING_POINTS_PER_LIST)
+                sample = vectors[np.random.default_rng(0).choice(n, sample_size, replace=False)]
+                target.train(sample)
+            target.add(vectors)
+
+            with self._lock:
+                # Catch up on vectors added while the target was being built
+                total = self.index.ntotal
+                if total > n:
+                    target.add(self.index.reconstruct_n(n, total - n))
+                self.index = target
+                self.active_backend = self.backend
+            logger.info(f"Index promoted to {self.backend}")
+        except Exception as e:
+            logger.error(f"Error promoting index to {self.backend}, staying on flat: {str(e)}")
+            self.backend = self.active_backend
+        finally:
+            self._promotion_thread = None
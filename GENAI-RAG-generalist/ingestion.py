@@ -0,0 +1,187 @@
+import time
+import hashlib
+import logging
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+import document_processor
+from document_processor import parse_upload, stream_document, extraction_pool, reset_extraction_pool
+from db_service import db_service
+from vector_store import INGEST_BATCH_SIZE
+from uploads import SpooledUpload, UploadedBytes, upload_buffer
+
+__all__ = ['ingest_files', 'IngestionResult', 'UploadedBytes', 'content_hash']
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class IngestionResult:
+    filename: str
+    metadata: Optional[Dict] = None
+    chunk_ids: List[int] = field(default_factory=list)
+    error: Optional[Exception] = None
+    seconds: float = 0.0
+    # Bytes were already indexed, the existing document was reused
+    deduplicated: bool = False
+
+
+def content_hash(data) -> str:
+    """Key of the content-hash registry in db_service."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def ingest_files(uploaded_files: List, vector_store,
+                 on_progress: Optional[Callable[[int, str], None]] = None,
+                 batch_size: Optional[int] = None,
+                 on_batch: Optional[Callable[[int, List[int]], None]] = None) -> List[IngestionResult]:
+    """Parse and index several uploaded files, overlapping their work.
+
+    Files are parsed in parallel by the extraction process pool. Files whose
+    parsing finished are embedded together, so small files share encoder
+    batches instead of each paying for a mostly empty one. A file whose
+    bytes were indexed before is attached to the session instead of being
+    parsed and embedded again. Uploads are told apart by their position in
+    uploaded_files, two of them may share a filename. on_progress is
+    called from the calling thread with (position, status), status being
+    'parsing', 'embedding', 'done' or 'error'; on_batch with (position,
+    row ids) each time a batch of a file's chunks becomes searchable.
+    Returns one result per upload, in order.
+    """
+    batch_size = batch_size or INGEST_BATCH_SIZE
+    started = time.perf_counter()
+    results = [IngestionResult(f.name) for f in uploaded_files]
+
+    def report(position: int, status: str) -> None:
+        if on_progress:
+            on_progress(position, status)
+
+    def fail(position: int, error: Exception) -> None:
+        logger.error(f"Error processing document {results[position].filename}: {str(error)}")
+        results[position].error = error
+        results[position].seconds = time.perf_counter() - started
+        report(position, 'error')
+
+    def batch_callback(position: int) -> Optional[Callable[[List[int]], None]]:
+        return (lambda ids: on_batch(position, ids)) if on_batch else None
+
+    hashes = {}
+    to_parse = []
+    for position, uploaded_file in enumerate(uploaded_files):
+        try:
+            with upload_buffer(uploaded_file) as view:
+                hashes[position] = content_hash(view)
+            if _reuse_duplicate(vector_store, hashes[position], results[position], started,
+                                batch_callback(position)):
+                report(position, 'done')
+                continue
+        except Exception as e:
+            fail(position, e)
+            continue
+        to_parse.append(position)
+
+    if len(to_parse) <= 1 or document_processor.EXTRACT_WORKERS < 2:
+        # Nothing to overlap across files; stream each one (large PDFs still extract pages in parallel)
+        for position in to_parse:
+            try:
+                report(position, 'parsing')
+                chunks, metadata = stream_document(uploaded_files[position])
+                metadata['content_hash'] = hashes[position]
+                report(position, 'embedding')
+                _index(vector_store, results[position], chunks, metadata, started, batch_callback(position))
+                report(position, 'done')
+            except Exception as e:
+                fail(position, e)
+        return results
+
+    pool = extraction_pool()
+    futures = {}
+    for position in to_parse:
+        uploaded_file = uploaded_files[position]
+        # A spooled upload is opened by path in the worker instead of being pickled over
+        source = uploaded_file.path if isinstance(uploaded_file, SpooledUpload) else uploaded_file.getvalue()
+        futures[pool.submit(parse_upload, uploaded_file.name, uploaded_file.size, uploaded_file.type,
+                            source)] = position
+        report(position, 'parsing')
+
+    # Parsed files waiting to be embedded together
+    pending: List[Tuple[int, List[str], Dict]] = []
+    remaining = len(futures)
+    for future in as_completed(futures):
+        remaining -= 1
+        position = futures[future]
+        try:
+            chunks, metadata = future.result()
+            metadata['content_hash'] = hashes[position]
+            pending.append((position, chunks, metadata))
+            report(position, 'embedding')
+        except BrokenProcessPool as e:
+            reset_extraction_pool()
+            fail(position, e)
+        except Exception as e:
+            fail(position, e)
+        if pending and (remaining == 0 or sum(len(chunks) for _, chunks, _ in pending) >= batch_size):
+            _index_pending(vector_store, pending, results, batch_size, started, report, fail, batch_callback)
+            pending = []
+    return results
+
+
+def _reuse_duplicate(vector_store, digest: str, result: IngestionResult, started: float,
+                     on_batch: Optional[Callable]) -> bool:
+    """Index a file from an earlier upload of the same bytes. Returns False if there was none."""
+    document_ids = db_service.find_documents_by_hash(digest)
+    if not document_ids:
+        return False
+    for document_id in document_ids:
+        rows = vector_store.attach_document(document_id, result.filename)
+        if rows is not None:
+            result.chunk_ids = rows
+            result.metadata = _duplicate_metadata(document_id, result.filename)
+            result.deduplicated = True
+            result.seconds = time.perf_counter() - started
+            return True
+
+    # Indexed in another group's shard: copy its chunks (their embeddings come from the cache)
+    document_id = document_ids[0]
+    chunks = sorted(db_service.get_chunks_by_document(document_id), key=lambda chunk: chunk['chunk_index'])
+    if not chunks:
+        return False
+    metadata = _duplicate_metadata(document_id, result.filename)
+    _index(vector_store, result, [chunk['text'] for chunk in chunks], metadata, started, on_batch)
+    result.deduplicated = True
+    return True
+
+
+def _duplicate_metadata(document_id: str, filename: str) -> Dict:
+    metadata = dict(db_service.get_document_by_id(document_id) or {})
+    metadata['filename'] = filename
+    return metadata
+
+
+def _index_pending(vector_store, pending: List[Tuple[int, List[str], Dict]], results: List[IngestionResult],
+                   batch_size: int, started: float, report: Callable, fail: Callable,
+                   batch_callback: Callable) -> None:
+    store = vector_store.store
+    all_chunks = [chunk for _, chunks, _ in pending for chunk in chunks]
+    try:
+        # One encoder pass over every pending file; add_documents then finds the vectors in the cache
+        if len(all_chunks) > store.embedding_cache.max_items:
+            all_chunks = []
+        for start in range(0, len(all_chunks), batch_size):
+            store.embedding_cache.encode(all_chunks[start:start + batch_size], store.embedding_batcher.encode)
+    except Exception as e:
+        logger.error(f"Error pre-encoding uploaded files, encoding per file: {str(e)}")
+    for position, chunks, metadata in pending:
+        try:
+            _index(vector_store, results[position], chunks, metadata, started, batch_callback(position))
+            report(position, 'done')
+        except Exception as e:
+            fail(position, e)
+
+
+def _index(vector_store, result: IngestionResult, chunks, metadata: Dict, started: float,
+           on_batch: Optional[Callable[[List[int]], None]]) -> None:
+    result.chunk_ids = vector_store.add_documents(chunks, metadata, on_batch=on_batch)
+    result.metadata = metadata
+    result.seconds = time.perf_counter() - started
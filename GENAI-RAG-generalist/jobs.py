@@ -0,0 +1,195 @@
+import os
+import json
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from typing import Dict, List, Optional
+import utils
+from ingestion import ingest_files
+from uploads import SpooledUpload, spool_upload
+from vector_store import SessionVectorStore, persist_shared_state
+
+__all__ = ['IngestionJob', 'IngestionJobQueue', 'get_job_queue']
+
+logger = logging.getLogger(__name__)
+
+# Upload batches indexed at the same time; each batch still parses its files in parallel
+INGEST_JOB_WORKERS = int(os.environ.get('INGEST_JOB_WORKERS', 2))
+# Finished jobs kept for status display
+INGEST_JOB_HISTORY = int(os.environ.get('INGEST_JOB_HISTORY', 500))
+
+ACTIVE_STATUSES = ('queued', 'parsing', 'embedding')
+
+
+@dataclass
+class IngestionJob:
+    job_id: str
+    filename: str
+    size: int
+    type: str
+    owner: Optional[str]
+    group: Optional[str]
+    status: str = 'queued'
+    chunks_indexed: int = 0
+    deduplicated: bool = False
+    error: Optional[str] = None
+    metadata: Optional[Dict] = None
+    submitted_at: str = field(default_factory=lambda: datetime.now().isoformat())
+    finished_at: Optional[str] = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ACTIVE_STATUSES
+
+
+class IngestionJobQueue:
+    """Process-wide queue indexing uploaded files in background threads.
+
+    Jobs outlive the Streamlit script run and session that submitted them:
+    status is looked up by job id or owner. Large uploads wait for their
+    turn in a spool file rather than in memory. When utils.DATA_DIR is set
+    every upload is spooled there until its job finishes, and jobs that
+    were pending when the process stopped are run again on start.
+    """
+
+    def __init__(self, workers: int = INGEST_JOB_WORKERS, path: Optional[str] = None):
+        self.path = path if path is not None else utils.ingest_jobs_dir()
+        self._jobs: Dict[str, IngestionJob] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingestion-job')
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+            self._resume()
+
+    def submit(self, uploaded_files: List, vector_store: Optional[SessionVectorStore] = None,
+               owner: Optional[str] = None, group: Optional[str] = None) -> List[IngestionJob]:
+        """Queue uploaded files as one batch and return their jobs immediately.
+
+        Indexed batches become searchable through vector_store as they land.
+        """
+        if vector_store is not None:
+            owner, group = vector_store.owner, vector_store.group
+        jobs, uploads = [], []
+        for uploaded_file in uploaded_files:
+            job = IngestionJob(str(uuid.uuid4()), uploaded_file.name, uploaded_file.size,
+                               uploaded_file.type, owner, group)
+            uploads.append(spool_upload(uploaded_file, self._payload_path(job)))
+            self._save_job(job)
+            jobs.append(job)
+        with self._lock:
+            for job in jobs:
+                self._jobs[job.job_id] = job
+        self._executor.submit(self._run, jobs, uploads, vector_store)
+        return jobs
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs_for(self, owner: str) -> List[IngestionJob]:
+        with self._lock:
+            return [job for job in self._jobs.values() if job.owner == owner]
+
+    def _run(self, jobs: List[IngestionJob], files: List,
+             vector_store: Optional[SessionVectorStore]) -> None:
+        view = vector_store or SessionVectorStore(group=jobs[0].group, owner=jobs[0].owner)
+
+        # Results and callbacks refer to a file by its position in the batch; filenames may repeat
+        def on_progress(position: int, status: str) -> None:
+            if status in ACTIVE_STATUSES:
+                jobs[position].status = status
+
+        def on_batch(position: int, ids: List[int]) -> None:
+            jobs[position].chunks_indexed += len(ids)
+
+        try:
+            results = ingest_files(files, view, on_progress=on_progress, on_batch=on_batch)
+        except Exception as e:
+            logger.error(f"Error running ingestion jobs: {str(e)}")
+            results = []
+            for job in jobs:
+                job.error = str(e)
+        for job, result in zip(jobs, results):
+            job.error = str(result.error) if result.error is not None else None
+            job.metadata = result.metadata
+            job.deduplicated = result.deduplicated
+            if result.deduplicated:
+                job.chunks_indexed = len(result.chunk_ids)
+        # Snapshot so a restart does not need a re-upload and re-embed
+        persist_shared_state()
+        finished_at = datetime.now().isoformat()
+        for job, upload in zip(jobs, files):
+            job.status = 'error' if job.error else 'done'
+            job.finished_at = finished_at
+            if isinstance(upload, SpooledUpload):
+                upload.discard()
+            self._remove_payload(job)
+        self._trim()
+
+    def _trim(self) -> None:
+        with self._lock:
+            finished = [job for job in self._jobs.values() if not job.active]
+            for job in finished[:max(0, len(finished) - INGEST_JOB_HISTORY)]:
+                del self._jobs[job.job_id]
+
+    def _payload_path(self, job: IngestionJob) -> Optional[str]:
+        """Where the job's upload is spooled, None to spool only large uploads to a temporary file."""
+        if not self.path:
+            return None
+        return os.path.join(self.path, f"{job.job_id}.bin")
+
+    def _save_job(self, job: IngestionJob) -> None:
+        if not self.path:
+            return
+        with open(os.path.join(self.path, f"{job.job_id}.json"), 'w') as f:
+            json.dump(asdict(job), f)
+
+    def _remove_payload(self, job: IngestionJob) -> None:
+        if not self.path:
+            return
+        for suffix in ('.bin', '.json'):
+            try:
+                os.remove(os.path.join(self.path, f"{job.job_id}{suffix}"))
+            except FileNotFoundError:
+                pass
+
+    def _resume(self) -> None:
+        """Queue again the jobs a previous process left unfinished."""
+        resumed: Dict[tuple, List] = {}
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    job = IngestionJob(**json.load(f))
+                payload_path = self._payload_path(job)
+                if not os.path.exists(payload_path):
+                    raise FileNotFoundError(payload_path)
+            except Exception as e:
+                logger.error(f"Error restoring ingestion job {name}: {str(e)}")
+                continue
+            job.status = 'queued'
+            job.chunks_indexed = 0
+            self._jobs[job.job_id] = job
+            upload = SpooledUpload(job.filename, job.size, job.type, payload_path)
+            resumed.setdefault((job.owner, job.group), []).append((job, upload))
+        for entries in resumed.values():
+            self._executor.submit(self._run, [job for job, _ in entries], [upload for _, upload in entries], None)
+        if resumed:
+            logger.info(f"Resumed {sum(len(entries) for entries in resumed.values())} ingestion jobs")
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> IngestionJobQueue:
+    """Return the process-wide ingestion job queue, starting it on first use."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = IngestionJobQueue()
+        return _job_queue
@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import threading
+from array import array
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+__all__ = ['BM25Index', 'reciprocal_rank_fusion']
+
+# Keeps identifiers such as part numbers ("AB-1234", "v2.3.1") as single tokens
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Constant of reciprocal rank fusion, dampens the weight of the very first ranks
+RRF_K = 60
+
+VOCABULARY_FILE = 'bm25_vocabulary.json'
+OFFSETS_FILE = 'bm25_offsets.npy'
+ROWS_FILE = 'bm25_rows.npy'
+FREQUENCIES_FILE = 'bm25_frequencies.npy'
+LENGTHS_FILE = 'bm25_lengths.npy'
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def reciprocal_rank_fusion(*rankings: List[int], k: int = RRF_K) -> List[Tuple[int, float]]:
+    """Fuse ranked lists of row ids into one list of (row, score), best first."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class BM25Index:
+    """In-process BM25 inverted index over chunk rows.
+
+    Postings are compact typed arrays (row ids as uint32, term frequencies as
+    uint16) appended incrementally. A snapshot is restored as memory-mapped
+    CSR arrays; postings added afterwards are kept alongside in memory.
+    """
+
+    def __init__(self):
+        self.vocabulary: Dict[str, int] = {}
+        self._rows: Dict[int, array] = {}
+        self._frequencies: Dict[int, array] = {}
+        self._lengths = array('I')
+        self._total_length = 0
+        self._lock = threading.Lock()
+        # Memory-mapped postings restored from a snapshot
+        self._base_terms = 0
+        self._base_offsets = None
+        self._base_rows = None
+        self._base_frequencies = None
+        self._base_lengths = None
+
+    def __len__(self) -> int:
+        return self._base_count + len(self._lengths)
+
+    @property
+    def _base_count(self) -> int:
+        return 0 if self._base_lengths is None else len(self._base_lengths)
+
+    @staticmethod
+    def analyze(texts: List[str]) -> List[Counter]:
+        """Tokenize texts into term counts (can run outside any lock)."""
+        return [Counter(tokenize(text)) for text in texts]
+
+    def add(self, start_row: int, analyzed: List[Counter]) -> None:
+        """Index analyzed chunks as rows start_row, start_row + 1, ..."""
+        with self._lock:
+            if start_row != len(self):
+                raise ValueError(f"Rows must be added in order: expected {len(self)}, got {start_row}")
+            for row, counts in enumerate(analyzed, start=start_row):
+                for term, frequency in counts.items():
+                    term_id = self.vocabulary.setdefault(term, len(self.vocabulary))
+                    if term_id not in self._rows:
+                        self._rows[term_id] = array('I')
+                        self._frequencies[term_id] = array('H')
+                    self._rows[term_id].append(row)
+                    self._frequencies[term_id].append(min(frequency, 65535))
+                length = sum(counts.values())
+                self._lengths.append(length)
+                self._total_length += length
+
+    def _postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        rows = [np.frombuffer(self._rows[term_id], dtype='uint32')] if term_id in self._rows else []
+        frequencies = [np.frombuffer(self._frequencies[term_id], dtype='uint16')] if term_id in self._rows else []
+        if term_id < self._base_terms:
+            start, end = self._base_offsets[term_id], self._base_offsets[term_id + 1]
+            rows.insert(0, self._base_rows[start:end])
+            frequencies.insert(0, self._base_frequencies[start:end])
+        if not rows:
+            return np.empty(0, dtype='uint32'), np.empty(0, dtype='uint16')
+        return np.concatenate(rows), np.concatenate(frequencies)
+
+    def _length_column(self) -> np.ndarray:
+        lengths = np.frombuffer(self._lengths, dtype='uint32')
+        if self._base_count:
+            lengths = np.concatenate([self._base_lengths, lengths])
+        return lengths
+
+    def search(self, query: str, k: int, allowed_ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (scores, rows) of the k best BM25 matches, best first."""
+        with self._lock:
+            n = len(self)
+            term_ids = [self.vocabulary[t] for t in set(tokenize(query)) if t in self.vocabulary]
+            if not n or not term_ids:
+                return np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+            lengths = self._length_column()
+            average_length = self._total_length / n
+            candidate_rows, contributions = [], []
+            for term_id in term_ids:
+                rows, frequencies = self._postings(term_id)
+                if allowed_ids is not None:
+                    mask = np.isin(rows, allowed_ids)
+                    rows, frequencies = rows[mask], frequencies[mask]
+                if not len(rows):
+                    continue
+                # Document frequency is global so scores do not depend on the filter
+                df = self._document_frequency(term_id)
+                idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+                tf = frequencies.astype('float32')
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / average_length)
+                candidate_rows.append(rows)
+                contributions.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+            # Drop the view on the length array before appends can resize it
+            del lengths
+
+        if not candidate_rows:
+            return np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+        unique_rows, inverse = np.unique(np.concatenate(candidate_rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype('float32')
+        top = np.argsort(-scores, kind='stable')[:k]
+        return scores[top], unique_rows[top].astype('int64')
+
+    def _document_frequency(self, term_id: int) -> int:
+        df = len(self._rows[term_id]) if term_id in self._rows else 0
+        if term_id < self._base_terms:
+            df += int(self._base_offsets[term_id + 1] - self._base_offsets[term_id])
+        return df
+
+    def save(self, path: str) -> None:
+        """Write the postings as CSR arrays (term offsets, rows, frequencies)."""
+        with self._lock:
+            terms = len(self.vocabulary)
+            offsets = np.zeros(terms + 1, dtype='int64')
+            rows, frequencies = [], []
+            for term_id in range(terms):
+                term_rows, term_frequencies = self._postings(term_id)
+                rows.append(term_rows)
+                frequencies.append(term_frequencies)
+                offsets[term_id + 1] = offsets[term_id] + len(term_rows)
+            with open(os.path.join(path, VOCABULARY_FILE), 'w', encoding='utf-8') as f:
+                json.dump(self.vocabulary, f)
+            np.save(os.path.join(path, OFFSETS_FILE), offsets)
+            np.save(os.path.join(path, ROWS_FILE), np.concatenate(rows) if rows else np.empty(0, dtype='uint32'))
+            np.save(os.path.join(path, FREQUENCIES_FILE),
+                    np.concatenate(frequencies) if frequencies else np.empty(0, dtype='uint16'))
+            np.save(os.path.join(path, LENGTHS_FILE), self._length_column())
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'BM25Index':
+        mmap_mode = 'r' if mmap else None
+        index = cls()
+        with open(os.path.join(path, VOCABULARY_FILE), encoding='utf-8') as f:
+            index.vocabulary = json.load(f)
+        index._base_terms = len(index.vocabulary)
+        index._base_offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode=mmap_mode)
+        index._base_rows = np.load(os.path.join(path, ROWS_FILE), mmap_mode=mmap_mode)
+        index._base_frequencies = np.load(os.path.join(path, FREQUENCIES_FILE), mmap_mode=mmap_mode)
+        index._base_lengths = np.load(os.path.join(path, LENGTHS_FILE), mmap_mode=mmap_mode)
+        index._total_length = int(index._base_lengths.sum())
+        return index
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.exists(os.path.join(path, VOCABULARY_FILE))
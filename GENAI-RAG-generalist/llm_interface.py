@@ -1,22 +1,77 @@
 import os
+import threading
+import httpx
 import openai
-from typing import Optional
+from typing import Dict, Iterator, Optional
 import time
+from llm_scheduler import RateLimited, get_llm_scheduler
+
+# 'stream' shows the answer token by token as it is generated; 'poll' waits for the whole answer
+LLM_RESPONSE_MODE = os.environ.get("LLM_RESPONSE_MODE", "stream")
+# Seconds to wait for an answer
+RUN_TIMEOUT = 60
+# Conexões HTTP mantidas abertas por chave de API
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 20))
+LLM_KEEPALIVE_SECONDS = float(os.environ.get("LLM_KEEPALIVE_SECONDS", 60))
+# Mensagens mais recentes de um thread reutilizado que o assistente lê a cada pergunta
+ASSISTANT_THREAD_MESSAGES = int(os.environ.get("ASSISTANT_THREAD_MESSAGES", 10))
+
+_clientes: Dict[str, openai.OpenAI] = {}
+_clientes_lock = threading.Lock()
+_chave_padrao: Optional[str] = None
 
 
 # Carregar chave da OpenAI
-def carregar_chave_openai(api_key: Optional[str] = None) -> None:
+def carregar_chave_openai(api_key: Optional[str] = None) -> str:
+    """Retorna a chave informada, a de openai_key.txt ou a de OPENAI_API_KEY.
+
+    A chave padrão (arquivo ou ambiente) é lida uma vez só; a variável
+    global openai.api_key não é alterada, cada chave tem seu cliente.
+    """
+    global _chave_padrao
     if api_key:
-        openai.api_key = api_key
-        print("Chave API carregada corretamente.")
-    elif os.path.exists("openai_key.txt"):
-        with open("openai_key.txt") as f:
-            openai.api_key = f.read().strip()
-            print("Chave API carregada corretamente.")
-    else:
-        openai.api_key = os.environ.get("OPENAI_API_KEY")
-        if not openai.api_key:
+        return api_key
+    if _chave_padrao is None:
+        if os.path.exists("openai_key.txt"):
+            with open("openai_key.txt") as f:
+                _chave_padrao = f.read().strip()
+        else:
+            _chave_padrao = os.environ.get("OPENAI_API_KEY") or None
+        if not _chave_padrao:
             raise ValueError("Erro: Nenhuma chave de API encontrada.")
+        print("Chave API carregada corretamente.")
+    return _chave_padrao
+
+
+def obter_cliente(api_key: Optional[str] = None) -> openai.OpenAI:
+    """Cliente OpenAI da chave, criado uma vez e compartilhado entre sessões e threads.
+
+    Cada cliente mantém seu pool de conexões HTTP abertas (keep-alive),
+    então as perguntas seguintes não pagam de novo o handshake TLS.
+    """
+    chave = carregar_chave_openai(api_key)
+    with _clientes_lock:
+        cliente = _clientes.get(chave)
+        if cliente is None:
+            cliente = openai.OpenAI(
+                api_key=chave,
+                # As novas tentativas (com backoff) ficam a cargo do llm_scheduler
+                max_retries=0,
+                http_client=openai.DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                        keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+                    )
+                ),
+            )
+            _clientes[chave] = cliente
+        return cliente
+
+
+def criar_thread(api_key: Optional[str] = None) -> str:
+    """Cria um thread vazio do assistente e retorna seu id."""
+    return obter_cliente(api_key).beta.threads.create().id
 
 
 def gerar_resposta_assistente(
@@ -24,73 +79,234 @@ def gerar_resposta_assistente(
     context: Optional[str] = None,
     api_key: Optional[str] = None,
     assistant_id: Optional[str] = None,
+    thread_id: Optional[str] = None,
+    session_id: Optional[str] = None,
 ) -> str:
+    """Resposta do assistente, aguardando o fim da execução.
+
+    Com thread_id a pergunta é adicionada a esse thread (a conversa da
+    sessão); sem ele um thread novo é criado. A chamada espera sua vez no
+    llm_scheduler, que reveza as sessões (session_id) de cada chave.
+    """
     try:
-        # Carregar chave de API
-        carregar_chave_openai(api_key)
+        cliente = obter_cliente(api_key)
 
         # Validar o assistant_id
         if not assistant_id:
             return "Erro: 'assistant_id' é obrigatório."
 
-        # Criar um novo thread para a conversa
-        thread = openai.beta.threads.create()
-
-        # Construir a mensagem com contexto opcional
-        user_message = (
-            query if not context else f"Context: {context}\n\nQuestion: {query}"
-        )
-
-        # Adicionar a mensagem ao thread
-        openai.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=user_message,
-        )
-
-        # Criar a execução do assistente
-        run = openai.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id=assistant_id,
-        )
-        print("Execução do assistente iniciada:", run)
-
-        # Aguardar a resposta do assistente com timeout e verificações de erro
-        start_time = time.time()
-        timeout = 60  # Defina um timeout de 60 segundos
-        while run.status in ["queued", "in_progress"]:
-            time.sleep(1)  # Pequeno delay para evitar chamadas excessivas
-            run = openai.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-
-            # Verificar o tempo decorrido e interromper se o tempo de espera exceder o timeout
-            elapsed_time = time.time() - start_time
-            if elapsed_time > timeout:
-                return "Erro: Timeout excedido enquanto aguardava pela resposta do assistente."
-
-            # Logar o status atual para depuração
-            print(f"Status atual do run: {run.status}")
-
-        if run.status == "completed":
-            # Acessando corretamente o conteúdo do assistente
-            messages = openai.beta.threads.messages.list(thread_id=thread.id)
-
-            # Acessando o conteúdo da resposta, verificando se é uma lista
-            message_content = messages.data[0].content
-            # Se o conteúdo for uma lista, acesse o primeiro item
-            if isinstance(message_content, list):
-                return message_content[0].text.value  # Acessando o valor do texto
+        agendador = get_llm_scheduler()
+        with agendador.slot(api_key, assistant_id, session_id):
+            thread_id = agendador.call(lambda: _adicionar_pergunta(cliente, query, context, thread_id))
+            return agendador.call(lambda: _executar_com_polling(cliente, thread_id, assistant_id))
+
+    except Exception as e:
+        return _mensagem_de_erro(e)
+
+
+def gerar_resposta_assistente_stream(
+    query: str,
+    context: Optional[str] = None,
+    api_key: Optional[str] = None,
+    assistant_id: Optional[str] = None,
+    metrics: Optional[Dict[str, float]] = None,
+    thread_id: Optional[str] = None,
+    session_id: Optional[str] = None,
+) -> Iterator[str]:
+    """Gera a resposta do assistente em pedaços de texto, à medida que os tokens chegam.
+
+    Feito para st.write_stream. metrics recebe 'time_to_first_token' e
+    'total_time' em segundos. Se o streaming falhar antes do primeiro
+    token, a resposta vem de gerar_resposta_assistente (polling), inteira.
+    thread_id e session_id funcionam como em gerar_resposta_assistente.
+    """
+    metrics = metrics if metrics is not None else {}
+    start_time = time.perf_counter()
+    first_token = True
+    question_added = False
+    agendador = get_llm_scheduler()
+    try:
+        cliente = obter_cliente(api_key)
+        if not assistant_id:
+            yield "Erro: 'assistant_id' é obrigatório."
+            return
+
+        # O slot fica ocupado até o fim do streaming
+        with agendador.slot(api_key, assistant_id, session_id):
+            thread_id = agendador.call(lambda: _adicionar_pergunta(cliente, query, context, thread_id))
+            question_added = True
+            events = agendador.call(lambda: cliente.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                stream=True,
+                timeout=RUN_TIMEOUT,
+                **_opcoes_de_execucao(),
+            ))
+            for event in events:
+                if event.event == "thread.message.delta":
+                    for block in event.data.delta.content or []:
+                        if block.type == "text" and block.text and block.text.value:
+                            if first_token:
+                                first_token = False
+                                metrics["time_to_first_token"] = time.perf_counter() - start_time
+                                print(f"Primeiro token em {metrics['time_to_first_token']:.2f}s")
+                            yield block.text.value
+                elif event.event == "thread.run.failed":
+                    if first_token and _limite_de_taxa(event.data):
+                        # Nada foi mostrado ainda: o polling tenta de novo com backoff
+                        raise RateLimited(event.data.last_error.message)
+                    yield "Erro: Execução do assistente falhou."
+                    return
+                elif event.event in ("thread.run.cancelled", "thread.run.expired", "thread.run.incomplete"):
+                    yield f"Erro inesperado: Status do run é {event.data.status}"
+                    return
+    except Exception as e:
+        # Sem slot livre a tempo, o polling também não teria
+        if first_token and not isinstance(e, TimeoutError):
+            print(f"Streaming indisponível, usando polling: {str(e)}")
+            if question_added:
+                # A pergunta já está no thread, o polling não a adiciona de novo
+                try:
+                    with agendador.slot(api_key, assistant_id, session_id):
+                        response = agendador.call(lambda: _executar_com_polling(cliente, thread_id, assistant_id))
+                except Exception as polling_error:
+                    response = _mensagem_de_erro(polling_error)
             else:
-                return message_content.text.value  # Caso seja um único objeto
+                response = gerar_resposta_assistente(query, context, api_key, assistant_id, thread_id, session_id)
+            metrics["time_to_first_token"] = time.perf_counter() - start_time
+            yield response
+        elif first_token:
+            yield _mensagem_de_erro(e)
+        else:
+            yield f"\n\n{_mensagem_de_erro(e)}"
+    finally:
+        metrics["total_time"] = time.perf_counter() - start_time
 
-        elif run.status == "failed":
-            return "Erro: Execução do assistente falhou."
 
+def registrar_resposta(
+    query: str,
+    context: Optional[str],
+    resposta: str,
+    api_key: Optional[str] = None,
+    thread_id: Optional[str] = None,
+) -> None:
+    """Adiciona ao thread uma pergunta respondida sem o assistente (pelo cache de respostas).
+
+    Assim as próximas perguntas da sessão veem a conversa que o usuário viu.
+    """
+    if thread_id is None:
+        return
+    try:
+        cliente = obter_cliente(api_key)
+        agendador = get_llm_scheduler()
+        agendador.call(lambda: _adicionar_pergunta(cliente, query, context, thread_id))
+        agendador.call(lambda: cliente.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="assistant",
+            content=resposta,
+        ))
+    except Exception as e:
+        print(f"Erro ao registrar a resposta no thread: {str(e)}")
+
+
+def resposta_valida(resposta) -> bool:
+    """Se a resposta veio do assistente, e não é (nem termina com) uma mensagem de erro."""
+    return isinstance(resposta, str) and bool(resposta) \
+        and not resposta.startswith("Erro") and "\n\nErro" not in resposta
+
+
+def _executar_com_polling(cliente: openai.OpenAI, thread_id: str, assistant_id: str) -> str:
+    """Executa o assistente no thread e aguarda a resposta consultando o status."""
+    # Criar a execução do assistente
+    run = cliente.beta.threads.runs.create(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        **_opcoes_de_execucao(),
+    )
+    print("Execução do assistente iniciada:", run)
+
+    # Aguardar a resposta do assistente com timeout e verificações de erro
+    start_time = time.time()
+    timeout = RUN_TIMEOUT
+    while run.status in ["queued", "in_progress"]:
+        time.sleep(1)  # Pequeno delay para evitar chamadas excessivas
+        run = cliente.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+
+        # Verificar o tempo decorrido e interromper se o tempo de espera exceder o timeout
+        elapsed_time = time.time() - start_time
+        if elapsed_time > timeout:
+            return "Erro: Timeout excedido enquanto aguardava pela resposta do assistente."
+
+        # Logar o status atual para depuração
+        print(f"Status atual do run: {run.status}")
+
+    if run.status == "completed":
+        # Acessando corretamente o conteúdo do assistente
+        messages = cliente.beta.threads.messages.list(thread_id=thread_id, limit=1)
+
+        # Acessando o conteúdo da resposta, verificando se é uma lista
+        message_content = messages.data[0].content
+        # Se o conteúdo for uma lista, acesse o primeiro item
+        if isinstance(message_content, list):
+            return message_content[0].text.value  # Acessando o valor do texto
         else:
-            return f"Erro inesperado: Status do run é {run.status}"
+            return message_content.text.value  # Caso seja um único objeto
 
-    except openai.error.AuthenticationError:
+    elif run.status == "failed":
+        if _limite_de_taxa(run):
+            raise RateLimited(run.last_error.message)
+        return "Erro: Execução do assistente falhou."
+
+    else:
+        return f"Erro inesperado: Status do run é {run.status}"
+
+
+def _adicionar_pergunta(cliente: openai.OpenAI, query: str, context: Optional[str],
+                       thread_id: Optional[str]) -> str:
+    """Adiciona a pergunta (e o contexto opcional) ao thread, criando um se thread_id for None."""
+    if thread_id is None:
+        # Criar um novo thread para a conversa
+        thread_id = cliente.beta.threads.create().id
+
+    # Construir a mensagem com contexto opcional
+    user_message = (
+        query if not context else f"Context: {context}\n\nQuestion: {query}"
+    )
+
+    # Adicionar a mensagem ao thread
+    cliente.beta.threads.messages.create(
+        thread_id=thread_id,
+        role="user",
+        content=user_message,
+    )
+    return thread_id
+
+
+def _opcoes_de_execucao() -> Dict:
+    # O thread da sessão cresce a cada pergunta (cada uma com seu contexto); o
+    # assistente lê só as mensagens recentes
+    return {
+        "truncation_strategy": {
+            "type": "last_messages",
+            "last_messages": ASSISTANT_THREAD_MESSAGES,
+        }
+    }
+
+
+def _limite_de_taxa(run) -> bool:
+    # Runs que falham por limite de taxa trazem o motivo em last_error, sem um 429
+    last_error = getattr(run, "last_error", None)
+    return last_error is not None and last_error.code == "rate_limit_exceeded"
+
+
+def _mensagem_de_erro(e: Exception) -> str:
+    # openai>=1.0 não tem mais o módulo openai.error
+    if isinstance(e, (openai.RateLimitError, RateLimited)):
+        return "Erro: Limite de requisições da API atingido. Tente novamente em instantes."
+    if isinstance(e, TimeoutError):
+        return "Erro: Muitas perguntas em andamento. Tente novamente em instantes."
+    if isinstance(e, openai.AuthenticationError):
         return "Erro de autenticação. Verifique sua chave de API."
-    except openai.error.InvalidRequestError as e:
+    if isinstance(e, openai.BadRequestError):
         return f"Erro de solicitação inválida: {e}"
-    except Exception as e:
-        return f"Erro: {str(e)}"
+    return f"Erro: {str(e)}"
@@ -0,0 +1,208 @@
+import os
+import time
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional, Tuple, TypeVar
+import openai
+
+__all__ = ['LLMScheduler', 'RateLimited', 'get_llm_scheduler']
+
+logger = logging.getLogger(__name__)
+
+# Assistant requests running at once per API key and assistant; the rest wait their turn
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 4))
+# Seconds a request waits for a slot before giving up
+LLM_QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', 120))
+# Retries of a rate-limited or failed call, waiting up to base * 2^attempt seconds (capped) before each
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 5))
+LLM_BACKOFF_BASE = float(os.environ.get('LLM_BACKOFF_BASE', 1.0))
+LLM_BACKOFF_MAX = float(os.environ.get('LLM_BACKOFF_MAX', 30.0))
+
+T = TypeVar('T')
+
+# Errors worth another try: what the SDK retried on its own before (it no longer does)
+RATE_LIMIT_ERRORS = (openai.RateLimitError,)
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+
+class RateLimited(Exception):
+    """A call the provider turned down for rate limits in its response rather than with a 429."""
+
+    def __init__(self, message: str = 'rate limit exceeded', retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    __slots__ = ('granted',)
+
+    def __init__(self):
+        self.granted = False
+
+
+class _Lane:
+    """Slots of one API key and assistant, with the sessions waiting for them."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        # Waiting tickets per session, and the sessions in the order they are served
+        self.waiting: Dict[str, Deque[_Ticket]] = {}
+        self.turns: Deque[str] = deque()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(tickets) for tickets in self.waiting.values())
+
+    def grant_next(self) -> None:
+        """Hand free slots to waiting sessions, one request per session in turn."""
+        while self.active < self.limit and self.turns:
+            session = self.turns.popleft()
+            tickets = self.waiting[session]
+            tickets.popleft().granted = True
+            self.active += 1
+            if tickets:
+                self.turns.append(session)
+            else:
+                del self.waiting[session]
+
+
+class LLMScheduler:
+    """Coordinates the assistant calls of every session in the process.
+
+    Each (API key, assistant) pair has at most max_concurrency requests in
+    flight. Waiting requests are served round-robin across sessions, so a
+    session asking many questions at once does not hold up the others.
+    Rate-limited calls are retried with exponential backoff and full
+    jitter (or the provider's retry-after), without giving up the slot,
+    so a lane under rate limits slows down instead of failing users.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, queue_timeout: float = LLM_QUEUE_TIMEOUT,
+                 max_retries: int = LLM_MAX_RETRIES, backoff_base: float = LLM_BACKOFF_BASE,
+                 backoff_max: float = LLM_BACKOFF_MAX):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lanes: 'OrderedDict[Tuple[str, str], _Lane]' = OrderedDict()
+        self._condition = threading.Condition()
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @contextmanager
+    def slot(self, api_key: Optional[str], assistant_id: Optional[str],
+             session_id: Optional[str] = None) -> Iterator[None]:
+        """Hold one of the lane's slots, waiting in the session's turn for it."""
+        lane_key = (hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16], assistant_id or '')
+        session = session_id or f"anonymous-{threading.get_ident()}"
+        ticket = _Ticket()
+        started = time.monotonic()
+        with self._condition:
+            lane = self._lanes.get(lane_key)
+            if lane is None:
+                lane = self._lanes[lane_key] = _Lane(self.max_concurrency)
+            if session not in lane.waiting:
+                lane.waiting[session] = deque()
+                lane.turns.append(session)
+            lane.waiting[session].append(ticket)
+            lane.grant_next()
+            while not ticket.granted:
+                remaining = self.queue_timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._withdraw(lane, session, ticket)
+                    self.timeouts += 1
+                    raise TimeoutError(f"no assistant slot free after {self.queue_timeout:g}s")
+                self._condition.wait(remaining)
+            waited = time.monotonic() - started
+            self.requests += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        if waited > 1:
+            logger.info(f"Assistant request waited {waited:.1f}s for a slot")
+        try:
+            yield
+        finally:
+            with self._condition:
+                lane.active -= 1
+                lane.grant_next()
+                self._condition.notify_all()
+
+    def call(self, fn: Callable[[], T]) -> T:
+        """Run fn, retrying it while the provider answers with rate limits or server errors."""
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except RATE_LIMIT_ERRORS + TRANSIENT_ERRORS + (RateLimited,) as e:
+                rate_limited = not isinstance(e, TRANSIENT_ERRORS)
+                with self._condition:
+                    self.rate_limited += rate_limited
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                with self._condition:
+                    self.retries += 1
+                reason = "Rate limited" if rate_limited else f"{type(e).__name__}"
+                logger.warning(f"{reason}, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+                attempt += 1
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        retry_after = getattr(error, 'retry_after', None)
+        response = getattr(error, 'response', None)
+        if retry_after is None and response is not None:
+            try:
+                retry_after = float(response.headers.get('retry-after'))
+            except (TypeError, ValueError):
+                retry_after = None
+        if retry_after is not None:
+            # A little jitter so the sessions told to wait do not all return at once
+            return min(self.backoff_max, retry_after) * random.uniform(1.0, 1.2)
+        # Full jitter: anywhere between no wait and the exponential cap
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _withdraw(self, lane: _Lane, session: str, ticket: _Ticket) -> None:
+        tickets = lane.waiting.get(session)
+        if tickets is None:
+            return
+        tickets.remove(ticket)
+        if not tickets:
+            del lane.waiting[session]
+            lane.turns.remove(session)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'requests': self.requests,
+                'active': sum(lane.active for lane in self._lanes.values()),
+                'queued': sum(lane.queued for lane in self._lanes.values()),
+                'avg_wait_seconds': self._wait_total / self.requests if self.requests else 0.0,
+                'max_wait_seconds': self._wait_max,
+                'rate_limited': self.rate_limited,
+                'retries': self.retries,
+                'timeouts': self.timeouts,
+                'lanes': len(self._lanes)
+            }
+
+
+_llm_scheduler = None
+_llm_scheduler_lock = threading.Lock()
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """Return the process-wide scheduler shared by all sessions."""
+    global _llm_scheduler
+    with _llm_scheduler_lock:
+        if _llm_scheduler is None:
+            _llm_scheduler = LLMScheduler()
+        return _llm_scheduler
@@ -5,9 +5,16 @@ from datetime import datetime
 import time
 import json
 from conversation_manager import ConversationManager
-from vector_store import VectorStore
-from document_processor import process_document
-from llm_interface import gerar_resposta_assistente
+from vector_store import SessionVectorStore
+from answer_cache import get_answer_cache
+from jobs import get_job_queue
+from llm_interface import (
+    gerar_resposta_assistente,
+    gerar_resposta_assistente_stream,
+    registrar_resposta,
+    resposta_valida,
+    LLM_RESPONSE_MODE,
+)
 from streamlit_js_eval import get_cookie, set_cookie, streamlit_js_eval
 from keycloak_auth import check_keycloak_auth, KeycloakAuth
 import requests
@@ -16,6 +23,9 @@ import requests
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# How often the sidebar refreshes background ingestion progress
+INGESTION_POLL_SECONDS = 2
+
 # JavaScript functions for localStorage
 local_storage_js = """
 <script>
@@ -124,7 +134,19 @@ st.title(title)
 if "conversation_manager" not in st.session_state:
     st.session_state.conversation_manager = ConversationManager()
 if "vector_store" not in st.session_state:
-    st.session_state.vector_store = VectorStore()
+    # Encoder and index are shared process-wide; the session only gets a view.
+    # Keyed by user so documents restored from a snapshot remain visible.
+    # Each group searches its own index shard.
+    owner = keycloak.get_user_info().get("sub")
+    group = user_groups[0][1:] if user_groups else None
+    st.session_state.vector_store = SessionVectorStore(group=group, owner=owner)
+if "ingestion_jobs" not in st.session_state:
+    # Jobs of this user still running from an earlier session keep reporting here
+    st.session_state.ingestion_jobs = [
+        job.job_id
+        for job in get_job_queue().jobs_for(st.session_state.vector_store.owner)
+        if job.active
+    ]
 if "session_id" not in st.session_state:
     st.session_state.session_id = st.session_state.conversation_manager.create_session()
 if "show_analytics" not in st.session_state:
@@ -180,6 +202,56 @@ if not st.session_state.welcome_message_shown:
     except Exception as e:
         logger.error(f"Error showing welcome message: {str(e)}")
 
+def show_ingestion_jobs(polling):
+    """Sidebar list of this session's background ingestion jobs."""
+    queue = get_job_queue()
+    still_active = False
+    for job_id in st.session_state.ingestion_jobs:
+        job = queue.get(job_id)
+        if job is None:
+            continue
+        still_active = still_active or job.active
+        if job.status == "done":
+            if f"processed_{job.filename}" not in st.session_state:
+                st.session_state[f"processed_{job.filename}"] = True
+                try:
+                    st.session_state.conversation_manager.add_message(
+                        st.session_state.session_id,
+                        "system",
+                        f"Document '{job.filename}' processed.",
+                        document_context=job.metadata,
+                    )
+                except ConnectionError as e:
+                    logger.error(f"Database connection error: {str(e)}")
+            reused = ", already indexed" if job.deduplicated else ""
+            st.success(f"✓ {job.filename} ({job.chunks_indexed} chunks{reused})")
+        elif job.status == "error":
+            # Not submitted again on the next rerun, only when the user asks to retry
+            st.session_state.pop(f"job_{job.filename}", None)
+            st.session_state[f"failed_{job.filename}"] = job.job_id
+            st.error(
+                f"❌ Não foi possível processar o arquivo {job.filename}. O arquivo pode estar protegido ou corrompido."
+            )
+        else:
+            # Chunks indexed so far are already searchable
+            st.info(f"⏳ {job.filename}: {job.status}, {job.chunks_indexed} chunks indexed")
+    if polling and not still_active:
+        # Full rerun to stop polling and refresh the rest of the page
+        st.rerun()
+
+
+def render_ingestion_jobs():
+    if not st.session_state.ingestion_jobs:
+        return
+    queue = get_job_queue()
+    active = any(
+        job is not None and job.active
+        for job in map(queue.get, st.session_state.ingestion_jobs)
+    )
+    # Poll only while something is still indexing
+    st.fragment(show_ingestion_jobs, run_every=INGESTION_POLL_SECONDS if active else None)(active)
+
+
 # Main content based on view state
 if st.session_state.show_analytics:
     # Import and render analytics dashboard
@@ -232,6 +304,8 @@ else:
             help="Upload documents to chat with",
         )
 
+        render_ingestion_jobs()
+
         st.divider()
 
         # Recuperar cookies
@@ -268,35 +342,29 @@ else:
         if uploaded_files:
             with st.container():
                 st.markdown("##### Document Processing Status")
+                to_process = []
                 for uploaded_file in uploaded_files:
-                    file_key = f"processed_{uploaded_file.name}"
-                    if file_key not in st.session_state:
-                        try:
-                            with st.spinner("Processing..."):
-                                chunks, metadata = process_document(uploaded_file)
-                                st.session_state.vector_store.add_documents(
-                                    chunks, metadata
-                                )
-                                st.session_state[file_key] = True
-
-                                try:
-                                    st.session_state.conversation_manager.add_message(
-                                        st.session_state.session_id,
-                                        "system",
-                                        f"Document '{metadata['filename']}' processed.",
-                                        document_context=metadata,
-                                    )
-                                except ConnectionError as e:
-                                    logger.error(f"Database connection error: {str(e)}")
-
-                            st.success(f"✓ Successfully processed {uploaded_file.name}")
-                        except Exception as e:
-                            logger.error(f"Error processing document: {str(e)}")
-                            st.error(
-                                f"❌ Não foi possível processar o arquivo {uploaded_file.name}. O arquivo pode estar protegido ou corrompido."
-                            )
-                    else:
+                    if f"processed_{uploaded_file.name}" in st.session_state:
                         st.info(f"✓ {uploaded_file.name} (already processed)")
+                    elif f"failed_{uploaded_file.name}" in st.session_state:
+                        st.error(f"❌ {uploaded_file.name} (could not be processed)")
+                        if st.button("Retry", key=f"retry_{uploaded_file.name}"):
+                            del st.session_state[f"failed_{uploaded_file.name}"]
+                            st.rerun()
+                    elif f"job_{uploaded_file.name}" in st.session_state:
+                        st.info(f"⏳ {uploaded_file.name} (indexing in background)")
+                    else:
+                        to_process.append(uploaded_file)
+
+                if to_process:
+                    # Indexed in the background; the sidebar shows progress and chat stays usable
+                    jobs = get_job_queue().submit(to_process, st.session_state.vector_store)
+                    for job in jobs:
+                        st.session_state[f"job_{job.filename}"] = job.job_id
+                        st.session_state.ingestion_jobs.append(job.job_id)
+                    # The sidebar job panel already rendered without these jobs in this run;
+                    # rerun so it starts polling their progress
+                    st.rerun()
 
         # Recuperar histórico do chat dos cookies
         history = get_cookie("chat_history")
@@ -335,6 +403,12 @@ else:
                                         st.caption(
                                             f"📄 Document: {doc_context['filename']}"
                                         )
+                                    if doc_context.get("cached"):
+                                        st.caption("Answered from cache")
+                                    elif "time_to_first_token" in doc_context:
+                                        st.caption(
+                                            f"First token in {doc_context['time_to_first_token']:.2f}s"
+                                        )
 
                             # Display timestamp
                             if timestamp := message.get("timestamp"):
@@ -377,52 +451,108 @@ else:
             # Assistant response
             with st.chat_message("assistant"):
                 try:
-                    with st.spinner("Thinking..."):
+                    answer_cache = get_answer_cache()
+                    with st.spinner("Searching documents..."):
                         context, context_metadata = (
                             st.session_state.vector_store.get_relevant_context(prompt)
                         )
-                        response = gerar_resposta_assistente(
-                            prompt, context, api_key, assistant_id
-                        )
-
-                        # Store messages
-                        try:
-                            # Add user message
-                            st.session_state.conversation_manager.add_message(
-                                st.session_state.session_id,
-                                "user",
-                                prompt,
-                                document_context={
-                                    "query_time": datetime.now().isoformat()
-                                },
+                        query_embedding = st.session_state.vector_store.query_embedding(prompt)
+                        # Only the first question of a conversation is standalone; follow-ups
+                        # ("and the second one?") depend on the session's earlier turns.
+                        # The welcome message comes before any question and is no turn.
+                        roles = [
+                            message.get("role")
+                            for message in st.session_state.conversation_manager.get_history(
+                                st.session_state.session_id
                             )
-
-                            # Add assistant response
-                            st.session_state.conversation_manager.add_message(
-                                st.session_state.session_id,
-                                "assistant",
-                                response,
-                                document_context={
-                                    "documents": [
-                                        meta.get("filename")
-                                        for meta in context_metadata
-                                    ],
-                                    "timestamp": datetime.now().isoformat(),
-                                },
+                        ]
+                        answered = "user" in roles and "assistant" in roles[roles.index("user"):]
+                        cacheable = bool(context_metadata) and not answered
+                        # Repeat questions over the same chunks skip the assistant run
+                        started = time.perf_counter()
+                        cached_response = answer_cache.get(
+                            st.session_state.vector_store.group, assistant_id,
+                            context_metadata, query_embedding
+                        ) if cacheable else None
+                    # One assistant thread per conversation, created on the first question
+                    thread_id = st.session_state.conversation_manager.assistant_thread(
+                        st.session_state.session_id, api_key
+                    )
+                    response_metrics = {}
+                    if cached_response is not None:
+                        response = cached_response
+                        response_metrics["total_time"] = time.perf_counter() - started
+                        response_metrics["cached"] = True
+                        st.write(response)
+                        st.caption("Answered from cache")
+                        # The thread has to hold this turn for the follow-up questions
+                        registrar_resposta(prompt, context, response, api_key, thread_id)
+                    else:
+                        if LLM_RESPONSE_MODE == "stream":
+                            # Tokens are shown as they arrive; time to first token is what users feel
+                            response = st.write_stream(
+                                gerar_resposta_assistente_stream(
+                                    prompt, context, api_key, assistant_id, response_metrics,
+                                    thread_id, st.session_state.session_id
+                                )
                             )
-
-                            # Update chat history in session state
-                            st.session_state.chat_history = (
-                                st.session_state.conversation_manager.get_history(
+                            if "time_to_first_token" in response_metrics:
+                                st.caption(
+                                    f"First token in {response_metrics['time_to_first_token']:.2f}s"
+                                )
+                        else:
+                            with st.spinner("Thinking..."):
+                                started = time.perf_counter()
+                                response = gerar_resposta_assistente(
+                                    prompt, context, api_key, assistant_id, thread_id,
                                     st.session_state.session_id
                                 )
+                                response_metrics["total_time"] = time.perf_counter() - started
+                            st.write(response)
+                        # Error messages are not answers worth repeating
+                        if cacheable and resposta_valida(response):
+                            answer_cache.put(
+                                st.session_state.vector_store.group, assistant_id,
+                                context_metadata, query_embedding, response
                             )
 
-                        except Exception as e:
-                            logger.error(f"Error saving messages: {str(e)}")
-                            st.warning("Response generated but history not saved")
+                    # Store messages
+                    try:
+                        # Add user message
+                        st.session_state.conversation_manager.add_message(
+                            st.session_state.session_id,
+                            "user",
+                            prompt,
+                            document_context={
+                                "query_time": datetime.now().isoformat()
+                            },
+                        )
 
-                        st.write(response)
+                        # Add assistant response
+                        st.session_state.conversation_manager.add_message(
+                            st.session_state.session_id,
+                            "assistant",
+                            response,
+                            document_context={
+                                "documents": [
+                                    meta.get("filename")
+                                    for meta in context_metadata
+                                ],
+                                "timestamp": datetime.now().isoformat(),
+                                **response_metrics,
+                            },
+                        )
+
+                        # Update chat history in session state
+                        st.session_state.chat_history = (
+                            st.session_state.conversation_manager.get_history(
+                                st.session_state.session_id
+                            )
+                        )
+
+                    except Exception as e:
+                        logger.error(f"Error saving messages: {str(e)}")
+                        st.warning("Response generated but history not saved")
 
                 except Exception as e:
                     logger.error(f"Error processing query: {str(e)}")
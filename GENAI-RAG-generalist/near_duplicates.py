@@ -0,0 +1,207 @@
+import os
+import re
+import hashlib
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional, Set
+import numpy as np
+
+__all__ = ['MinHashIndex', 'find_duplicates', 'is_near_duplicate', 'normalized', 'shingles', 'band_keys',
+           'similarity', 'key_terms']
+
+# Collapse chunks that repeat word for word (headers, footers, disclaimers) into one indexed
+# row, and near-duplicate chunks retrieved for the same question into one context entry
+NEAR_DUPLICATE_DEDUP = os.environ.get('NEAR_DUPLICATE_DEDUP', 'true').lower() == 'true'
+# Shingle overlap (Jaccard) at which two retrieved chunks count as the same text; besides,
+# their numbers and codes (words with a digit) must match exactly, see key_terms()
+NEAR_DUPLICATE_MIN_SIMILARITY = float(os.environ.get('NEAR_DUPLICATE_MIN_SIMILARITY', 0.95))
+
+# Candidates verified per chunk at most, bounds the work for very common text
+NEAR_DUPLICATE_MAX_CANDIDATES = 32
+
+SHINGLE_WORDS = 3
+# 16 bands of 4 MinHash values: pairs at 0.95 similarity share a band with probability
+# ~1.0, pairs at 0.3 with 0.12; candidates are then verified on their shingles
+BANDS = 16
+ROWS_PER_BAND = 4
+NUM_HASHES = BANDS * ROWS_PER_BAND
+
+SIGNATURES_FILE = 'minhash_bands.npy'
+
+WORD = re.compile(r'\w+')
+
+_rng = np.random.default_rng(0x5EED)
+# Multiply-shift hash functions, one per MinHash value
+_MULTIPLIERS = _rng.integers(1, 2 ** 63, NUM_HASHES, dtype='uint64') | np.uint64(1)
+_OFFSETS = _rng.integers(0, 2 ** 63, NUM_HASHES, dtype='uint64')
+# Mixes the values of a band into one key
+_BAND_MIX = _rng.integers(1, 2 ** 63, ROWS_PER_BAND, dtype='uint64') | np.uint64(1)
+
+
+def normalized(text: str) -> str:
+    """Text with its whitespace collapsed, what two chunks must share to be the same chunk."""
+    return ' '.join(text.split())
+
+
+def shingles(text: str) -> Set[str]:
+    """Overlapping word trigrams of a text (its words when shorter)."""
+    words = WORD.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def key_terms(features: Set[str]) -> Set[str]:
+    """Words of a shingle set holding a digit: quantities, prices, dates, part numbers."""
+    return {word for shingle in features for word in shingle.split() if any(c.isdigit() for c in word)}
+
+
+def band_keys(features: Iterable[str]) -> np.ndarray:
+    """MinHash signature of a feature set, folded into one 32-bit key per band."""
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+         for feature in features),
+        dtype='uint64'
+    )
+    if not hashes.size:
+        return np.zeros(BANDS, dtype='uint32')
+    with np.errstate(over='ignore'):
+        minimums = ((hashes[:, None] * _MULTIPLIERS + _OFFSETS) >> np.uint64(32)).min(axis=0)
+        keys = (minimums.reshape(BANDS, ROWS_PER_BAND) * _BAND_MIX).sum(axis=1, dtype='uint64')
+    return (keys >> np.uint64(32)).astype('uint32')
+
+
+def similarity(a: Set[str], b: Set[str]) -> float:
+    """Jaccard similarity of two shingle sets."""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def is_near_duplicate(a: Set[str], b: Set[str]) -> bool:
+    """Whether two shingle sets are the same text but for a few words, with the same figures."""
+    return similarity(a, b) >= NEAR_DUPLICATE_MIN_SIMILARITY and key_terms(a) == key_terms(b)
+
+
+class MinHashIndex:
+    """Locality-sensitive index of the MinHash band keys of index rows.
+
+    Each row keeps BANDS 32-bit keys (64 bytes). Rows sharing a key in any
+    band are candidate near-duplicates. A snapshot is restored as a
+    memory-mapped key matrix with one sorted column per band; rows added
+    afterwards are kept in per-band hash tables.
+    """
+
+    def __init__(self):
+        self._keys = array('I')
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in range(BANDS)]
+        # Restored from a snapshot: key matrix, and per band the sorted keys and their rows
+        self._base = np.empty((0, BANDS), dtype='uint32')
+        self._base_keys: List[np.ndarray] = []
+        self._base_rows: List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return len(self._base) + len(self._keys) // BANDS
+
+    @property
+    def nbytes(self) -> int:
+        base = self._base.nbytes + sum(k.nbytes + r.nbytes for k, r in zip(self._base_keys, self._base_rows))
+        # Keys plus one bucket entry per band
+        return base + len(self._keys) * (4 + 8)
+
+    def add(self, start_row: int, keys: List[np.ndarray]) -> None:
+        """Index band keys as rows start_row, start_row + 1, ..."""
+        if start_row != len(self):
+            raise ValueError(f"Rows must be added in order: expected {len(self)}, got {start_row}")
+        for row, row_keys in enumerate(keys, start=start_row):
+            self._keys.extend(row_keys.tolist())
+            for band, key in enumerate(row_keys.tolist()):
+                self._buckets[band].setdefault(key, []).append(row)
+
+    def candidates(self, keys: np.ndarray) -> List[int]:
+        """Rows sharing at least one band key with keys, most shared bands first."""
+        shared: Dict[int, int] = {}
+        for band, key in enumerate(keys.tolist()):
+            rows = list(self._buckets[band].get(key, ()))
+            if self._base_keys:
+                lo = np.searchsorted(self._base_keys[band], key, side='left')
+                hi = np.searchsorted(self._base_keys[band], key, side='right')
+                rows.extend(self._base_rows[band][lo:hi].tolist())
+            for row in rows:
+                shared[row] = shared.get(row, 0) + 1
+        return sorted(shared, key=lambda row: (-shared[row], row))
+
+    def save(self, path: str) -> None:
+        keys = np.frombuffer(self._keys, dtype='uint32').reshape(-1, BANDS)
+        np.save(os.path.join(path, SIGNATURES_FILE), np.concatenate([self._base, keys]))
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, SIGNATURES_FILE))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'MinHashIndex':
+        """Restore keys saved with save() and sort each band for lookup."""
+        index = cls()
+        index._base = np.load(os.path.join(path, SIGNATURES_FILE), mmap_mode='r' if mmap else None)
+        for band in range(BANDS):
+            order = np.argsort(index._base[:, band], kind='stable').astype('uint32')
+            index._base_keys.append(np.ascontiguousarray(index._base[order, band]))
+            index._base_rows.append(order)
+        return index
+
+    @classmethod
+    def build(cls, texts: Iterable[str]) -> 'MinHashIndex':
+        """Index the keys of texts as rows 0, 1, ... (snapshots written before keys were kept)."""
+        index = cls()
+        index.add(0, [band_keys(shingles(text)) for text in texts])
+        return index
+
+
+def find_duplicates(texts: List[str], keys: List[np.ndarray], index: MinHashIndex,
+                    text_of: Callable[[int], str],
+                    accept: Optional[Callable[[int], bool]] = None) -> List[Optional[int]]:
+    """For each text, an indexed row holding the same text (whitespace aside), or None.
+
+    Identical texts share every band key, so the index's candidates are
+    checked for equality: text_of(row) returns a candidate row's text.
+    accept(row) may exclude candidate rows. Nearly identical texts are not
+    duplicates here; a changed word ("may" / "may not") can change the
+    meaning, and a collapsed chunk's own text is never stored.
+    """
+    found: List[Optional[int]] = []
+    for text, text_keys in zip(texts, keys):
+        match = None
+        wanted = normalized(text)
+        candidates = [row for row in index.candidates(text_keys) if accept is None or accept(row)]
+        for row in candidates[:NEAR_DUPLICATE_MAX_CANDIDATES]:
+            if normalized(text_of(row)) == wanted:
+                match = row
+                break
+        found.append(match)
+    return found
+
+
+if __name__ == '__main__':
+    # python near_duplicates.py: chunks differing only in their figures stay separate
+    clause = ("The Supplier shall deliver {quantity} units of the Product to the Buyer's warehouse no later "
+              "than thirty days after the Effective Date, at a unit price of {price} USD, excluding taxes. "
+              "Deliveries shall be accompanied by a packing list and a certificate of conformity issued by "
+              "the Supplier's quality department. The Buyer may reject any delivery that does not conform "
+              "to the specifications in Annex A, in which case the Supplier shall replace the rejected "
+              "units at its own cost within ten business days of the notice of rejection.")
+    texts = [clause.format(quantity=500, price='12.40'),
+             clause.format(quantity=750, price='11.90'),
+             clause.format(quantity=500, price='12.40') + " ",
+             clause.format(quantity=500, price='12.40').replace("may reject", "may not reject")]
+    index = MinHashIndex()
+    features = [shingles(text) for text in texts]
+    keys = [band_keys(f) for f in features]
+    index.add(0, keys[:1])
+    found = find_duplicates(texts[1:], keys[1:], index, lambda row: texts[row])
+    print(f"different figures: similarity {similarity(features[0], features[1]):.3f}, duplicate of {found[0]}, "
+          f"near-duplicate {is_near_duplicate(features[0], features[1])}")
+    print(f"same text: duplicate of {found[1]}")
+    print(f"one word changed: similarity {similarity(features[0], features[3]):.3f}, duplicate of {found[2]}, "
+          f"near-duplicate {is_near_duplicate(features[0], features[3])}")
+    assert found == [None, 0, None], "only identical chunks may share a row"
+    assert not is_near_duplicate(features[0], features[1]), "chunks differing in their figures were merged"
@@ -0,0 +1,151 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+import numpy as np
+
+__all__ = ['QueryBatcher']
+
+logger = logging.getLogger(__name__)
+
+# Longest time a query waits for others to join its batch
+QUERY_BATCH_WAIT_MS = float(os.environ.get('QUERY_BATCH_WAIT_MS', 5))
+QUERY_BATCH_MAX_SIZE = int(os.environ.get('QUERY_BATCH_MAX_SIZE', 32))
+# Extra candidates fetched per query so per-session filtering still leaves k results
+QUERY_OVERFETCH = int(os.environ.get('QUERY_OVERFETCH', 4))
+
+
+@dataclass
+class _QueryRequest:
+    query: str
+    k: int
+    allowed_ids: Optional[np.ndarray]
+    nprobe: Optional[int]
+    ef_search: Optional[int]
+    future: Future = field(default_factory=Future)
+
+
+class QueryBatcher:
+    """Coalesces concurrent queries into one encoder pass and one index search.
+
+    Callers block in search() while a single worker thread collects requests
+    for up to max_wait_ms (or max_batch_size requests), encodes them as one
+    batch, runs one batched search per set of search parameters and hands
+    each caller its own (distances, indices) row.
+    """
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], search_fn: Callable,
+                 max_wait_ms: float = QUERY_BATCH_WAIT_MS, max_batch_size: int = QUERY_BATCH_MAX_SIZE):
+        self.encode_fn = encode_fn
+        self.search_fn = search_fn
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.queries = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def search(self, query: str, k: int, allowed_ids: Optional[np.ndarray] = None,
+               nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Encode and search one query as part of the next batch."""
+        self._ensure_worker()
+        request = _QueryRequest(query, k, allowed_ids, nprobe, ef_search)
+        self._queue.put(request)
+        return request.future.result()
+
+    def close(self) -> None:
+        """Stop the worker thread once queued requests are served."""
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(None)
+            self._thread = None
+
+    def _ensure_worker(self) -> None:
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='query-batcher', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.error(f"Error processing query batch: {str(e)}")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+            if stop:
+                return
+
+    def _process(self, batch: List[_QueryRequest]) -> None:
+        embeddings = np.asarray(self.encode_fn([request.query for request in batch]), dtype='float32')
+        self.batches += 1
+        self.queries += len(batch)
+
+        # One index search per distinct set of tuning parameters
+        groups = {}
+        for position, request in enumerate(batch):
+            groups.setdefault((request.nprobe, request.ef_search), []).append(position)
+
+        for (nprobe, ef_search), positions in groups.items():
+            requests = [batch[p] for p in positions]
+            if any(request.allowed_ids is None for request in requests):
+                allowed = None
+                k_fetch = max(request.k for request in requests)
+                if len(requests) > 1:
+                    k_fetch *= QUERY_OVERFETCH
+            else:
+                # Restrict the shared search to the union of the sessions' rows
+                allowed = np.unique(np.concatenate([request.allowed_ids for request in requests]))
+                distinct_sets = len({request.allowed_ids.tobytes() for request in requests})
+                k_fetch = min(allowed.size, max(request.k for request in requests) * (
+                    QUERY_OVERFETCH if distinct_sets > 1 else 1))
+            distances, indices = self.search_fn(
+                embeddings[positions], k_fetch, allowed_ids=allowed, nprobe=nprobe, ef_search=ef_search
+            )
+            for row, request in enumerate(requests):
+                request.future.set_result(
+                    self._select(request, embeddings[positions[row]], distances[row], indices[row])
+                )
+
+    def _select(self, request: _QueryRequest, embedding: np.ndarray,
+                distances: np.ndarray, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Keep this request's top k from the shared results."""
+        keep = indices >= 0
+        if request.allowed_ids is not None:
+            keep &= np.isin(indices, request.allowed_ids)
+        distances, indices = distances[keep][:request.k], indices[keep][:request.k]
+
+        # Unrestricted queries already got their exact top k from the shared search
+        if request.allowed_ids is not None and len(indices) < min(request.k, request.allowed_ids.size):
+            # The shared candidates were not enough for this session, search it on its own
+            distances, indices = self.search_fn(
+                embedding[np.newaxis], request.k, allowed_ids=request.allowed_ids,
+                nprobe=request.nprobe, ef_search=request.ef_search
+            )
+            return distances[0], indices[0]
+        return distances, indices
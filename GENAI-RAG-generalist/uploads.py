@@ -0,0 +1,122 @@
+import io
+import os
+import mmap
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Union
+
+__all__ = ['UploadedBytes', 'SpooledUpload', 'spool_upload', 'open_upload', 'upload_buffer', 'upload_path']
+
+# Uploads larger than this are written to a file on disk instead of staying in memory
+UPLOAD_SPOOL_THRESHOLD_MB = float(os.environ.get('UPLOAD_SPOOL_THRESHOLD_MB', 8))
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class UploadedBytes(io.BytesIO):
+    """Stand-in for a Streamlit UploadedFile (in parsing workers and background jobs)."""
+
+    def __init__(self, name: str, size: int, type: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+        self.size = size
+        self.type = type
+
+
+class SpooledUpload:
+    """Uploaded file kept in a file on disk, with the name, size and type of an UploadedFile.
+
+    Extractors read it through open_upload() or upload_buffer(), so its
+    content is paged in from disk as it is parsed instead of being held in
+    memory as a whole. Parsing workers open the same file by path.
+    """
+
+    def __init__(self, name: str, size: int, type: str, path: str, owned: bool = True):
+        self.name = name
+        self.size = size
+        self.type = type
+        self.path = path
+        # Whether discard() removes the file
+        self.owned = owned
+
+    def getvalue(self) -> bytes:
+        """The whole content as bytes (a copy in memory, prefer open_upload)."""
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def discard(self) -> None:
+        if self.owned:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+Upload = Union[SpooledUpload, io.BytesIO]
+
+
+def spool_upload(uploaded_file, path: Optional[str] = None,
+                 threshold_mb: float = UPLOAD_SPOOL_THRESHOLD_MB) -> Upload:
+    """Move an upload to disk when it is large (or a path is given) and return what to ingest.
+
+    Small uploads are returned unchanged. Large ones are copied in blocks
+    to path, or to a temporary file, and returned as a SpooledUpload that
+    the caller discards once ingested.
+    """
+    if isinstance(uploaded_file, SpooledUpload) or (path is None and uploaded_file.size <= threshold_mb * 1024 * 1024):
+        return uploaded_file
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix='upload-', suffix=os.path.splitext(uploaded_file.name)[1])
+        os.close(fd)
+    with open_upload(uploaded_file) as source, open(path, 'wb') as target:
+        shutil.copyfileobj(source, target, COPY_BLOCK_SIZE)
+    return SpooledUpload(uploaded_file.name, uploaded_file.size, uploaded_file.type, path)
+
+
+def open_upload(upload: Upload) -> BinaryIO:
+    """A new seekable binary stream over an upload's content; the caller closes it.
+
+    For an in-memory upload the stream shares its buffer (BytesIO does not
+    copy an unmodified bytes value).
+    """
+    if isinstance(upload, SpooledUpload):
+        return open(upload.path, 'rb')
+    return io.BytesIO(upload.getvalue())
+
+
+@contextmanager
+def upload_buffer(upload: Upload) -> Iterator[memoryview]:
+    """Read-only view of an upload's content: its in-memory buffer or a memory map of its file."""
+    if not isinstance(upload, SpooledUpload):
+        view = memoryview(upload.getvalue())
+        try:
+            yield view
+        finally:
+            view.release()
+        return
+    with open(upload.path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            # An empty file cannot be mapped
+            yield memoryview(b'')
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+
+@contextmanager
+def upload_path(upload: Upload, suffix: str = '') -> Iterator[str]:
+    """Path of a file holding an upload's content, written to a temporary file if it is in memory."""
+    if isinstance(upload, SpooledUpload):
+        yield upload.path
+        return
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        with upload_buffer(upload) as view:
+            f.write(view)
+    try:
+        yield f.name
+    finally:
+        os.unlink(f.name)
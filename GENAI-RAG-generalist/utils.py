@@ -1,9 +1,32 @@
+import os
 import re
 from typing import List
 
 # Global settings
 MAX_CHUNK_SIZE = 800  
 SIMILARITY_THRESHOLD = 0.7
+# Directory for on-disk snapshots (vector index, chunks, db state); empty disables persistence
+DATA_DIR = os.environ.get('RAG_DATA_DIR', '')
+
+def vector_store_dir() -> str:
+    """Directory holding the vector store snapshot, or '' when persistence is off."""
+    return os.path.join(DATA_DIR, 'vector_store') if DATA_DIR else ''
+
+def vector_shard_dir(shard: str) -> str:
+    """Directory holding one group's vector store shard, or '' when persistence is off."""
+    return os.path.join(DATA_DIR, 'vector_shards', shard) if DATA_DIR else ''
+
+def embedding_cache_path() -> str:
+    """SQLite file backing the on-disk embedding cache tier, or '' when persistence is off."""
+    return os.path.join(DATA_DIR, 'embedding_cache.sqlite') if DATA_DIR else ''
+
+def ingest_jobs_dir() -> str:
+    """Directory holding uploads of unfinished ingestion jobs, or '' when persistence is off."""
+    return os.path.join(DATA_DIR, 'ingest_jobs') if DATA_DIR else ''
+
+def db_snapshot_path() -> str:
+    """File holding the db_service snapshot, or '' when persistence is off."""
+    return os.path.join(DATA_DIR, 'db_service.pkl') if DATA_DIR else ''
 
 def split_into_sentences(text: str) -> List[str]:
     """Split text into sentences using regex."""
@@ -1,74 +1,416 @@
-from typing import List, Dict, Tuple
-import faiss
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator, Callable
+import os
+import json
+import shutil
+import hashlib
+import threading
+import itertools
+import uuid
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 import numpy as np
-from sentence_transformers import SentenceTransformer
 import utils
 from datetime import datetime
 import re
 from sklearn.preprocessing import normalize
 from db_service import db_service
+from index_backends import ManagedIndex
+from chunk_store import ChunkStore
+from embedding_cache import EmbeddingCache
+from embedding_batcher import EmbeddingBatcher
+from encoders import Encoder, load_checked_encoder
+from embedding_store import EmbeddingStore, python_list_bytes
+from query_batcher import QueryBatcher
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from answer_cache import get_answer_cache
+from context_packing import CONTEXT_MIN_SIMILARITY, pack_context
+from near_duplicates import (MinHashIndex, NEAR_DUPLICATE_DEDUP, band_keys, find_duplicates, is_near_duplicate,
+                             normalized, shingles)
+
+__all__ = ['VectorStore', 'SessionVectorStore', 'ShardRegistry', 'get_encoder', 'get_embedding_cache', 'get_shard_registry', 'get_shared_store', 'persist_shared_state']  # Add this line to explicitly export VectorStore
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+# Fuse BM25 keyword hits with dense hits; catches exact identifiers embeddings miss
+HYBRID_SEARCH = os.environ.get('HYBRID_SEARCH', 'true').lower() == 'true'
+# Candidates taken from each retriever per requested result before fusion
+HYBRID_CANDIDATES = 4
+# Chunks embedded and indexed together while a document streams in
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 256))
+# Restricted searches over at most this many rows of an approximate index are done exactly
+EXACT_SEARCH_MAX_ROWS = int(os.environ.get('EXACT_SEARCH_MAX_ROWS', 20000))
+# Query embeddings kept after a search, so the answer cache does not encode the question again
+RECENT_QUERY_EMBEDDINGS = 256
+
+INDEX_FILE = 'index.faiss'
+EMBEDDINGS_FILE = 'embeddings.npy'
+MANIFEST_FILE = 'manifest.json'
+
+# Shard used by sessions without a group
+DEFAULT_SHARD = 'default'
+# Resident shards beyond this estimate are saved to disk and dropped, least recently used first
+VECTOR_SHARD_MEMORY_BUDGET_MB = float(os.environ.get('VECTOR_SHARD_MEMORY_BUDGET_MB', 2048))
+
+# Process-wide singletons shared by every Streamlit session
+_encoder = None
+_encoder_lock = threading.Lock()
+_embedding_cache = None
+_shard_registry = None
+# Snapshots may be requested by the script thread and background ingestion jobs at once
+_persist_lock = threading.Lock()
+# Owner generations of every store, process-wide so a reloaded shard never repeats one
+_generations = itertools.count(1)
+
+
+def get_encoder() -> Encoder:
+    """Return the process-wide sentence encoder, loading it on first use.
+
+    The backend (torch, onnx, onnx_int8) comes from ENCODER_BACKEND.
+    """
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            _encoder = load_checked_encoder(EMBEDDING_MODEL)
+        return _encoder
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Return the process-wide embedding cache (on disk too when utils.DATA_DIR is set)."""
+    global _embedding_cache
+    with _encoder_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(EMBEDDING_MODEL, path=utils.embedding_cache_path() or None)
+        return _embedding_cache
+
+
+def get_shard_registry() -> 'ShardRegistry':
+    """Return the process-wide registry of per-group vector store shards."""
+    global _shard_registry
+    with _encoder_lock:
+        if _shard_registry is None:
+            _shard_registry = ShardRegistry()
+        return _shard_registry
+
+
+def get_shared_store(group: Optional[str] = None) -> 'VectorStore':
+    """Return the shared vector store of a group, loading it on first use.
+
+    The store may be evicted later; long-lived callers should go through
+    get_shard_registry().lease() instead of keeping the reference.
+    """
+    return get_shard_registry().get(group)
+
+
+def persist_shared_state() -> None:
+    """Snapshot every resident shard and db_service to utils.DATA_DIR, if configured."""
+    if not utils.DATA_DIR:
+        return
+    try:
+        with _persist_lock:
+            # db_service first: a crash before the shards are saved leaves it ahead of them, and a
+            # document it has that a shard lacks is indexed again from its chunks when re-uploaded.
+            # A shard ahead of it (saved here or on eviction) is matched on load, see _register_uploads.
+            db_service.save(utils.db_snapshot_path())
+            get_shard_registry().save_all()
+    except Exception as e:
+        logger.error(f"Error persisting snapshot: {str(e)}")
+
+
+def _batched(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _drop_near_duplicates(ranked: List[Tuple[float, Dict]]) -> List[Tuple[float, Dict]]:
+    """Leave out candidates that nearly repeat a better ranked one (e.g. two revisions of a clause)."""
+    kept: List[Tuple[float, Dict]] = []
+    kept_features: List[set] = []
+    for similarity, metadata in ranked:
+        features = shingles(metadata['text'])
+        if any(is_near_duplicate(features, other) for other in kept_features):
+            continue
+        kept.append((similarity, metadata))
+        kept_features.append(features)
+    return kept
 
-__all__ = ['VectorStore']  # Add this line to explicitly export VectorStore
 
 class VectorStore:
-    def __init__(self):
-        self.encoder = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(self, encoder: Optional[Encoder] = None, index_backend: Optional[str] = None,
+                 embedding_cache: Optional[EmbeddingCache] = None):
+        self.encoder = encoder or get_encoder()
+        self.embedding_cache = embedding_cache or get_embedding_cache()
+        # Ingestion encodes chunks in length-sorted batches
+        self.embedding_batcher = EmbeddingBatcher(self.encoder)
         self.dimension = 384  # Output dimension of the chosen model
-        self.index = faiss.IndexFlatL2(self.dimension)
-        self.documents = []
-        self.metadata = []  # List to store metadata for each document chunk
+        # Starts as an exact flat index and promotes itself to index_backend when it grows
+        self.index = ManagedIndex(self.dimension, backend=index_backend)
+        # Chunk text and metadata, addressed by index row id
+        self.chunks = ChunkStore()
+        # Normalized embeddings in one contiguous array, row n for index row n
+        self.embeddings = EmbeddingStore(self.dimension)
+        # Keyword index over the same rows for hybrid retrieval
+        self.lexical = BM25Index()
+        # MinHash band keys of the rows, to find repeated chunks and collapse them into one row
+        self.near_duplicates = MinHashIndex()
+        # Guards index, chunks and embeddings so row ids stay aligned across threads
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        # Concurrent queries from all sessions share encoder passes and index searches
+        self.query_batcher = QueryBatcher(self._encode_queries, self._search_index)
+        self._recent_queries: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._recent_queries_lock = threading.Lock()
+        # Chunk count of the last snapshot written or loaded, to skip saving unchanged shards
+        self.snapshot_chunks = None
+        # memory_usage() as of the last change, read by the shard registry without taking the lock
+        self.memory_bytes = 0
+        # Bumped when an owner's visible chunks change, so session views know to refresh
+        self._initial_generation = next(_generations)
+        self._owner_generations: Dict[Optional[str], int] = {}
 
-    def add_documents(self, chunks: List[str], doc_metadata: Dict[str, any]) -> None:
-        """Add document chunks to the vector store with metadata."""
-        if not chunks:
-            return
+    def add_documents(self, chunks: Iterable[str], doc_metadata: Dict[str, any],
+                      owner: Optional[str] = None, batch_size: Optional[int] = None,
+                      on_batch: Optional[Callable[[List[int]], None]] = None) -> List[int]:
+        """Add document chunks to the vector store with metadata.
+
+        chunks may be any iterable, e.g. a generator still extracting the
+        document. It is embedded and indexed in batches of batch_size chunks,
+        so early chunks are searchable before the last ones are extracted;
+        on_batch receives the row ids each indexed batch added.
+        A chunk that repeats one the same owner already indexed word for word
+        (headers, footers, disclaimers) gets no row of its own: it is
+        recorded as another source of the existing row. Nearly identical
+        chunks keep their rows; they are merged at retrieval time.
+        Returns the index row id of each chunk, in order.
+        """
+        batch_size = batch_size or INGEST_BATCH_SIZE
+        base_metadata = doc_metadata or {}
+        document = None
+        doc_row = None
+        ids: List[int] = []
+        stored_chunks: List[Dict] = []
         
         try:
-            # Convert text chunks to embeddings
-            embeddings = self.encoder.encode(chunks)
-            
-            # Normalize embeddings for better similarity search
-            normalized_embeddings = normalize(embeddings)
-            
-            # Add to FAISS index
-            self.index.add(np.array(normalized_embeddings).astype('float32'))
-            self.documents.extend(chunks)
-            
-            # Add metadata for each chunk
-            base_metadata = doc_metadata or {}
-            chunk_metadata = []
-            
-            # Store document in MongoDB
-            document_id = db_service.store_document(base_metadata)
-            
-            # Prepare chunks with embeddings for MongoDB
-            chunks_to_store = []
-            for i, (chunk, embedding) in enumerate(zip(chunks, normalized_embeddings)):
-                metadata = base_metadata.copy()
-                metadata.update({
-                    'chunk_index': i,
-                    'chunk_size': len(chunk),
-                    'total_chunks': len(chunks),
-                    'added_at': datetime.now().isoformat(),
-                    'text': chunk,
-                    'embedding': embedding.tolist()
-                })
-                chunks_to_store.append(metadata)
-                chunk_metadata.append(metadata)
+            for batch in _batched(chunks, batch_size):
+                signatures = [band_keys(shingles(chunk)) for chunk in batch]
+                with self._lock:
+                    duplicate_of = self._find_duplicates(batch, signatures, owner)
+                kept = [i for i, row in enumerate(duplicate_of) if row is None]
+                kept_chunks = [batch[i] for i in kept]
+                
+                # Convert text chunks to embeddings (outside the lock, this is the slow part).
+                # Chunks already seen by any session come from the cache.
+                if kept_chunks:
+                    embeddings = self.embedding_cache.encode(kept_chunks, self.embedding_batcher.encode)
+                    
+                    # Normalize embeddings for better similarity search
+                    normalized_embeddings = normalize(embeddings)
+                    
+                    normalized_embeddings = np.array(normalized_embeddings).astype('float32')
+                    
+                    analyzed = BM25Index.analyze(kept_chunks)
+                
+                if document is None:
+                    # Store document in MongoDB
+                    document_id = db_service.store_document(base_metadata)
+                    
+                    # Document-level metadata is kept once and shared by all of its chunks
+                    added_at = datetime.now().isoformat()
+                    document = base_metadata.copy()
+                    document.update({
+                        'document_id': document_id,
+                        'total_chunks': 0,
+                        'added_at': added_at,
+                        'owner': owner
+                    })
+                
+                # Add to FAISS index
+                with self._lock:
+                    if doc_row is None:
+                        doc_row = self.chunks.add_document(document)
+                    start = len(self.chunks)
+                    if kept_chunks:
+                        start = self.index.add(normalized_embeddings)
+                        self.embeddings.append(normalized_embeddings)
+                        self.lexical.add(start, analyzed)
+                        self.near_duplicates.add(start, [signatures[i] for i in kept])
+                        self.chunks.extend(doc_row, kept_chunks, [len(ids) + i for i in kept])
+                    rows = self._assign_rows(duplicate_of, kept, start)
+                    for i, row in enumerate(rows):
+                        if duplicate_of[i] is not None:
+                            self.chunks.add_source(row, doc_row, len(ids) + i)
+                            # Sources are saved with the snapshot even when no row was added
+                            self.snapshot_chunks = None
+                    document['total_chunks'] = len(ids) + len(batch)
+                    self._owner_generations[owner] = next(_generations)
+                    self.memory_bytes = self.memory_usage()
+                
+                # Chunks for MongoDB reference their embedding by offset instead of carrying a copy
+                chunks_to_store = []
+                for i, chunk in enumerate(batch):
+                    metadata = base_metadata.copy()
+                    metadata.update({
+                        'chunk_index': len(ids) + i,
+                        'chunk_size': len(chunk),
+                        'added_at': added_at,
+                        'text': chunk,
+                        'embedding_offset': rows[i]
+                    })
+                    chunks_to_store.append(metadata)
+                
+                # Store chunks in MongoDB
+                db_service.store_chunks(document_id, chunks_to_store)
+                stored_chunks.extend(chunks_to_store)
+                
+                ids.extend(rows)
+                if on_batch and kept_chunks:
+                    on_batch(list(range(start, start + len(kept_chunks))))
             
-            # Store chunks in MongoDB
-            db_service.store_chunks(document_id, chunks_to_store)
+            if document is not None:
+                # Metadata only known once the whole document was read (e.g. its size)
+                with self._lock:
+                    document.update(base_metadata)
+                    document['total_chunks'] = len(ids)
+                    # Marks the document whole in snapshots, see ShardRegistry._register_uploads
+                    document['completed_at'] = datetime.now().isoformat()
+                for metadata in stored_chunks:
+                    metadata['total_chunks'] = len(ids)
+                # Only a completely indexed document may stand in for later identical uploads
+                if base_metadata.get('content_hash'):
+                    db_service.register_content_hash(base_metadata['content_hash'], document_id)
             
-            self.metadata.extend(chunk_metadata)
+            return ids
             
         except Exception as e:
             print(f"Error adding documents to vector store: {str(e)}")
             raise
 
+    def _find_duplicates(self, batch: List[str], signatures: List[np.ndarray],
+                         owner: Optional[str]) -> List[Optional[int]]:
+        """Return, for each chunk of a batch, what it collapses into.
+
+        That is an indexed row id, -1 - position for an earlier chunk of the
+        same batch, or None for a chunk that needs its own row. Call with
+        the lock held.
+        """
+        if not NEAR_DUPLICATE_DEDUP:
+            return [None] * len(batch)
+        # Only rows of the owner's own documents, sessions must not see other owners' text
+        found = find_duplicates(
+            batch, signatures, self.near_duplicates, self.chunks.text,
+            accept=lambda row: self.chunks.documents[self.chunks.doc_row(row)].get('owner') == owner
+        )
+        # Repeats within the batch itself
+        positions: Dict[str, int] = {}
+        for i, row in enumerate(found):
+            if row is not None:
+                continue
+            text = normalized(batch[i])
+            if text in positions:
+                found[i] = -1 - positions[text]
+            else:
+                positions[text] = i
+        return found
+
+    @staticmethod
+    def _assign_rows(duplicate_of: List[Optional[int]], kept: List[int], start: int) -> List[int]:
+        """Row id of each chunk of a batch whose kept chunks were added from row start."""
+        rows = [0] * len(duplicate_of)
+        for offset, i in enumerate(kept):
+            rows[i] = start + offset
+        for i, row in enumerate(duplicate_of):
+            if row is not None:
+                rows[i] = row if row >= 0 else rows[-1 - row]
+        return rows
+
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        embeddings = np.array(normalize(self.encoder.encode(queries))).astype('float32')
+        with self._recent_queries_lock:
+            for query, embedding in zip(queries, embeddings):
+                self._recent_queries[query] = embedding
+                self._recent_queries.move_to_end(query)
+            while len(self._recent_queries) > RECENT_QUERY_EMBEDDINGS:
+                self._recent_queries.popitem(last=False)
+        return embeddings
+
+    def query_embedding(self, query: str) -> np.ndarray:
+        """Normalized embedding of a query, reused from its search when it just ran."""
+        with self._recent_queries_lock:
+            embedding = self._recent_queries.get(query)
+        if embedding is not None:
+            return embedding
+        return self._encode_queries([query])[0]
+
+    def _search_index(self, queries: np.ndarray, k: int, allowed_ids: Optional[np.ndarray] = None,
+                      **search_params) -> Tuple[np.ndarray, np.ndarray]:
+        # IVF/HNSW filter allowed rows out of the few lists or graph nodes they visit, so a
+        # small allowed set (a session's documents in a large shard) loses recall there
+        if allowed_ids is not None and self.index.active_backend != 'flat' \
+                and allowed_ids.size <= EXACT_SEARCH_MAX_ROWS:
+            return self._exact_search(queries, k, allowed_ids)
+        return self.index.search(queries, k, allowed_ids=allowed_ids, **search_params)
+
+    def _exact_search(self, queries: np.ndarray, k: int, allowed_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Brute-force search over allowed_ids, with the squared L2 distances of the flat index."""
+        with self._lock:
+            rows = allowed_ids[allowed_ids < len(self.embeddings)]
+            vectors = self.embeddings.get(rows)
+        # Embeddings are normalized: |q - v|^2 = 2 - 2 q.v
+        distances = 2 - 2 * (queries @ vectors.T)
+        top = min(k, rows.size)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :top]
+        result_distances = np.full((len(queries), k), np.inf, dtype='float32')
+        result_ids = np.full((len(queries), k), -1, dtype='int64')
+        result_distances[:, :top] = np.take_along_axis(distances, order, axis=1)
+        result_ids[:, :top] = rows[order]
+        return result_distances, result_ids
+
+    def chunk_ids_for_owner(self, owner: str) -> List[int]:
+        """Return the row ids of every chunk added by or shared with an owner."""
+        with self._lock:
+            return self.chunks.rows_for_documents(self.chunks.documents_visible_to(owner)).tolist()
+
+    def owner_generation(self, owner: Optional[str]) -> int:
+        """A number that changes whenever chunks are added for or shared with owner."""
+        with self._lock:
+            return self._owner_generations.get(owner, self._initial_generation)
+
+    def attach_document(self, document_id: str, owner: Optional[str],
+                        filename: Optional[str] = None) -> Optional[List[int]]:
+        """Share an indexed document with owner and return its row ids.
+
+        filename is the name owner uploaded the same bytes under; owner's
+        context and metadata show it instead of the first uploader's.
+        Returns None when the document is not in this store.
+        """
+        with self._lock:
+            for doc_row, doc in enumerate(self.chunks.documents):
+                if doc.get('document_id') != document_id:
+                    continue
+                if owner and owner != doc.get('owner'):
+                    if owner not in doc.get('shared_with', ()):
+                        doc.setdefault('shared_with', []).append(owner)
+                        self._owner_generations[owner] = next(_generations)
+                    if filename:
+                        doc.setdefault('shared_names', {})[owner] = filename
+                    # The change has to reach the next snapshot even without new chunks
+                    self.snapshot_chunks = None
+                return self.chunks.rows_for_documents([doc_row]).tolist()
+        return None
+
     def get_document_stats(self) -> Dict[str, any]:
-        """Get statistics about stored documents."""
+        """Get statistics about stored documents, including embedding memory use."""
         try:
-            return db_service.get_document_stats()
+            stats = db_service.get_document_stats()
+            stats['embedding_storage'] = self.embedding_memory_stats()
+            stats['embedding_throughput'] = self.embedding_batcher.stats()
+            stats['answer_cache'] = get_answer_cache().stats()
+            return stats
         except Exception as e:
             print(f"Error getting document stats: {str(e)}")
             return {
@@ -78,39 +420,448 @@ class VectorStore:
                 'formats': []
             }
 
-    def get_relevant_context(self, query: str, k: int = 5) -> Tuple[str, List[Dict[str, any]]]:
-        """Retrieve relevant context and metadata for the query."""
-        if not self.documents:
+    def embedding_memory_stats(self) -> Dict[str, any]:
+        """Report embedding memory against storing each vector as a Python float list."""
+        count = len(self.embeddings)
+        list_bytes = count * python_list_bytes(self.dimension)
+        return {
+            'dtype': self.embeddings.dtype,
+            'embeddings': count,
+            'bytes': self.embeddings.nbytes,
+            'python_list_bytes': list_bytes,
+            'bytes_saved': list_bytes - self.embeddings.nbytes
+        }
+
+    def memory_usage(self) -> int:
+        """Approximate bytes held by the index, embeddings, chunk text and BM25 postings."""
+        with self._lock:
+            # BM25 postings cost about as much as the chunk text they index
+            return self.index.memory_usage() + self.embeddings.nbytes + 2 * self.chunks.nbytes \
+                + self.near_duplicates.nbytes
+
+    @property
+    def is_dirty(self) -> bool:
+        """Whether chunks were added since the last snapshot."""
+        return self.snapshot_chunks != len(self.chunks)
+
+    def get_relevant_context(self, query: str, k: int = 5,
+                             allowed_ids: Optional[Iterable[int]] = None,
+                             nprobe: Optional[int] = None,
+                             ef_search: Optional[int] = None,
+                             owner: Optional[str] = None) -> Tuple[str, List[Dict[str, any]]]:
+        """Retrieve relevant context and metadata for the query.
+
+        When allowed_ids is given, only those index rows are considered.
+        nprobe/ef_search tune approximate backends for this query only.
+        owner limits the chunks' metadata to the documents owner may see and
+        names shared ones by the filename owner uploaded them under.
+        The top k chunks are packed into the prompt context by
+        context_packing.pack_context (similarity threshold, token budget).
+        """
+        if not len(self.chunks):
             return "", []
         
         try:
-            # Get query embedding and normalize
-            query_embedding = self.encoder.encode([query])
-            normalized_query = normalize(query_embedding)
+            allowed = None
+            if allowed_ids is not None:
+                allowed = np.fromiter(allowed_ids, dtype='int64')
+                if allowed.size == 0:
+                    return "", []
+                k = min(k, allowed.size)
+            candidates = k * HYBRID_CANDIDATES if HYBRID_SEARCH else k
+            if allowed is not None:
+                candidates = min(candidates, allowed.size)
             
-            # Search for similar chunks
-            distances, indices = self.index.search(
-                np.array(normalized_query).astype('float32'),
-                k
+            # Encode and search together with other sessions' concurrent queries
+            distances, indices = self.query_batcher.search(
+                query,
+                candidates,
+                allowed_ids=allowed,
+                nprobe=nprobe,
+                ef_search=ef_search
             )
+            dense_rows = [int(idx) for idx in indices if idx >= 0]
+            keyword_rows = set()
             
-            # Format context with source information
-            contexts = []
-            metadata_list = []
+            if HYBRID_SEARCH:
+                _, lexical_rows = self.lexical.search(query, candidates, allowed_ids=allowed)
+                rows = [row for row, _ in reciprocal_rank_fusion(dense_rows, lexical_rows.tolist())[:k]]
+                keyword_rows = set(lexical_rows[:k].tolist())
+            else:
+                rows = dense_rows[:k]
             
-            for idx, distance in zip(indices[0], distances[0]):
-                if idx >= len(self.documents):  # Safety check
-                    continue
-                    
-                chunk = self.documents[idx]
-                metadata = self.metadata[idx]
-                
-                contexts.append(f"From {metadata.get('filename', 'Unknown')}:\n{chunk}")
-                metadata_list.append(metadata)
+            rows = [idx for idx in rows if idx < len(self.chunks)]  # Safety check
+            if not rows:
+                return "", []
             
-            formatted_context = "\n\n".join(contexts)
+            # Cosine similarity of every candidate; top keyword matches (exact identifiers
+            # the embedding misses) are kept whatever their similarity
+            similarities = self.embeddings.get(np.asarray(rows)) @ self.query_embedding(query)
+            ranked = []
+            for idx, similarity in zip(rows, similarities):
+                # Described by owner's documents only, never by the others it stands for
+                metadata = self.chunks.metadata(idx, owner)
+                if metadata is None:
+                    continue
+                ranked.append((max(float(similarity), CONTEXT_MIN_SIMILARITY) if idx in keyword_rows
+                               else float(similarity), metadata))
+            if NEAR_DUPLICATE_DEDUP:
+                ranked = _drop_near_duplicates(ranked)
+            formatted_context, metadata_list, packing = pack_context(ranked)
+            logger.info(f"Context: {packing['chunks']} of {packing['candidates']} chunks in "
+                        f"{packing['blocks']} blocks, {packing['tokens']} tokens "
+                        f"({packing['tokens_saved']} saved)")
             return formatted_context, metadata_list
             
         except Exception as e:
             print(f"Error in retrieval: {str(e)}")
             return "", []
+
+    def save(self, path: str) -> None:
+        """Snapshot the index, chunk text and metadata to a directory.
+
+        The snapshot is written next to path and swapped in, so a crash
+        mid-write never leaves a half-written snapshot behind.
+        """
+        # Eviction and persist_shared_state may save the same shard at once
+        with self._save_lock:
+            self._save(path)
+
+    def _save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        with self._lock:
+            self.index.save(os.path.join(tmp_path, INDEX_FILE))
+            self.chunks.save(tmp_path)
+            self.embeddings.save(os.path.join(tmp_path, EMBEDDINGS_FILE))
+            self.lexical.save(tmp_path)
+            self.near_duplicates.save(tmp_path)
+            manifest = {
+                'model': EMBEDDING_MODEL,
+                'dimension': self.dimension,
+                'backend': self.index.active_backend,
+                'total_chunks': len(self.chunks),
+                'saved_at': datetime.now().isoformat()
+            }
+            self.snapshot_chunks = manifest['total_chunks']
+        with open(os.path.join(tmp_path, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f)
+
+        old_path = f"{path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        # Files still mapped by this process stay readable after removal
+        shutil.rmtree(old_path, ignore_errors=True)
+        logger.info(f"Saved vector store snapshot with {manifest['total_chunks']} chunks to {path}")
+
+    @classmethod
+    def load(cls, path: str, encoder: Optional[Encoder] = None,
+             index_backend: Optional[str] = None, mmap: bool = True,
+             embedding_cache: Optional[EmbeddingCache] = None) -> 'VectorStore':
+        """Restore a snapshot written by save() without re-embedding anything."""
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        if manifest.get('model') != EMBEDDING_MODEL:
+            raise ValueError(f"Snapshot was built with {manifest.get('model')}, expected {EMBEDDING_MODEL}")
+
+        store = cls(encoder=encoder, index_backend=index_backend, embedding_cache=embedding_cache)
+        store.index = ManagedIndex.load(os.path.join(path, INDEX_FILE), backend=index_backend, mmap=mmap)
+        store.chunks = ChunkStore.load(path, mmap=mmap)
+        embeddings_path = os.path.join(path, EMBEDDINGS_FILE)
+        if os.path.exists(embeddings_path):
+            store.embeddings = EmbeddingStore.load(embeddings_path, mmap=mmap)
+        else:
+            # Snapshots written before embeddings were stored separately
+            store.embeddings.append(store.index.index.reconstruct_n(0, store.index.ntotal))
+        if BM25Index.exists(path):
+            store.lexical = BM25Index.load(path, mmap=mmap)
+        else:
+            # Snapshots written before hybrid search: tokenizing is cheap next to re-embedding
+            store.lexical.add(0, BM25Index.analyze([store.chunks.text(i) for i in range(len(store.chunks))]))
+        if MinHashIndex.exists(path):
+            store.near_duplicates = MinHashIndex.load(path, mmap=mmap)
+        else:
+            # Snapshots written before near-duplicate detection
+            store.near_duplicates = MinHashIndex.build(store.chunks.text(i) for i in range(len(store.chunks)))
+        if not store.index.ntotal == len(store.chunks) == len(store.embeddings) == len(store.lexical) \
+                == len(store.near_duplicates):
+            raise ValueError(f"Snapshot is inconsistent: {store.index.ntotal} vectors, {len(store.embeddings)} "
+                             f"embeddings, {len(store.lexical)} BM25 rows for {len(store.chunks)} chunks")
+        store.snapshot_chunks = len(store.chunks)
+        store.memory_bytes = store.memory_usage()
+        logger.info(f"Loaded vector store snapshot with {len(store.chunks)} chunks from {path}")
+        return store
+
+
+class ShardRegistry:
+    """Per-group VectorStore shards, loaded lazily and evicted under a memory budget.
+
+    Each group gets its own index, so a query only searches its group's
+    chunks. When the estimated memory of resident shards exceeds the budget,
+    the least recently used shards that nobody holds a lease on are saved
+    to disk and dropped; the next access loads them back from their snapshot.
+    Eviction needs utils.DATA_DIR, without it every shard stays resident.
+    """
+
+    def __init__(self, memory_budget_mb: float = VECTOR_SHARD_MEMORY_BUDGET_MB,
+                 store_factory=None, store_loader=None):
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.store_factory = store_factory or VectorStore
+        self.store_loader = store_loader or VectorStore.load
+        self.loads = 0
+        self.evictions = 0
+        self._shards: 'OrderedDict[str, VectorStore]' = OrderedDict()
+        # Shards picked for eviction and being saved; a get() meanwhile takes them back
+        self._evicting: Dict[str, VectorStore] = {}
+        self._leases: Dict[str, int] = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def shard_name(group: Optional[str]) -> str:
+        """Return a directory-safe name for a group."""
+        if not group:
+            return DEFAULT_SHARD
+        name = re.sub(r'[^\w-]', '_', group)
+        if name != group:
+            # Keep distinct groups distinct after replacing characters
+            name = f"{name}-{hashlib.blake2b(group.encode('utf-8'), digest_size=4).hexdigest()}"
+        return name
+
+    def get(self, group: Optional[str] = None) -> VectorStore:
+        """Return a group's shard, loading it from disk or creating it if needed."""
+        name = self.shard_name(group)
+        with self._lock:
+            store, loaded = self._resident(name)
+        if loaded:
+            self._evict()
+        return store
+
+    @contextmanager
+    def lease(self, group: Optional[str] = None):
+        """Hold a group's shard resident for the duration of a with-block."""
+        name = self.shard_name(group)
+        with self._lock:
+            store, loaded = self._resident(name)
+            self._leases[name] = self._leases.get(name, 0) + 1
+        if loaded:
+            self._evict()
+        try:
+            yield store
+        finally:
+            with self._lock:
+                self._leases[name] -= 1
+                if not self._leases[name]:
+                    del self._leases[name]
+            # The shard may have grown while leased
+            self._evict()
+
+    def _resident(self, name: str) -> Tuple[VectorStore, bool]:
+        """Return a shard, making it resident; and whether it had to be loaded. Call with the lock held."""
+        loaded = False
+        store = self._shards.get(name)
+        if store is None:
+            # A shard still being saved for eviction is taken back as is, its snapshot may be incomplete
+            store = self._evicting.get(name)
+            if store is None:
+                store = self._load(name)
+                loaded = True
+            self._shards[name] = store
+        self._shards.move_to_end(name)
+        return store, loaded
+
+    def _load(self, name: str) -> VectorStore:
+        for path in self._snapshot_paths(name):
+            if os.path.exists(os.path.join(path, MANIFEST_FILE)):
+                try:
+                    store = self.store_loader(path)
+                    self.loads += 1
+                    self._register_uploads(name, store)
+                    return store
+                except Exception as e:
+                    logger.error(f"Error restoring vector store shard {name}, starting empty: {str(e)}")
+                    break
+        return self.store_factory()
+
+    @staticmethod
+    def _register_uploads(name: str, store: VectorStore) -> None:
+        """Register the uploads of a restored shard that the db snapshot, saved before it, lacks.
+
+        Without this, uploading the same bytes again would parse and embed them again.
+        """
+        registered = 0
+        for document in store.chunks.documents:
+            digest, document_id = document.get('content_hash'), document.get('document_id')
+            # Documents still being indexed when the shard was saved are not whole
+            if not digest or not document.get('completed_at'):
+                continue
+            if document_id not in db_service.find_documents_by_hash(digest):
+                db_service.register_content_hash(digest, document_id)
+                registered += 1
+        if registered:
+            logger.warning(f"Shard {name} is newer than the db snapshot, registered {registered} of its uploads")
+
+    @staticmethod
+    def _snapshot_paths(name: str) -> List[str]:
+        path = utils.vector_shard_dir(name)
+        if not path:
+            return []
+        if name == DEFAULT_SHARD:
+            # Snapshots written before sharding hold the default shard
+            return [path, utils.vector_store_dir()]
+        return [path]
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Estimated bytes of each resident shard."""
+        with self._lock:
+            # Kept up to date by the shards themselves; asking them would wait for their ingestion
+            return {name: store.memory_bytes for name, store in self._shards.items()}
+
+    def _evict(self) -> None:
+        """Save and drop least recently used shards while over the memory budget.
+
+        Victims are picked under the registry lock but saved after releasing
+        it, so queries on other shards never wait for a snapshot to be written.
+        """
+        if not utils.DATA_DIR:
+            return
+        victims = []
+        with self._lock:
+            total = sum(store.memory_bytes for store in self._shards.values())
+            # Never evict the most recently used shard, it is about to be queried
+            for name in list(self._shards)[:-1]:
+                if total <= self.memory_budget:
+                    break
+                store = self._shards[name]
+                if self._leases.get(name) or store.index.is_promoting or name in self._evicting:
+                    continue
+                del self._shards[name]
+                self._evicting[name] = store
+                total -= store.memory_bytes
+                victims.append((name, store))
+        for name, store in victims:
+            try:
+                if store.is_dirty:
+                    store.save(utils.vector_shard_dir(name))
+                saved = True
+            except Exception as e:
+                logger.error(f"Error saving vector store shard {name}, keeping it resident: {str(e)}")
+                saved = False
+            with self._lock:
+                del self._evicting[name]
+                if self._shards.get(name) is store:
+                    # Taken back by a get() while it was being saved
+                    continue
+                if not saved:
+                    self._shards[name] = store
+                    self._shards.move_to_end(name, last=False)
+                    continue
+                self.evictions += 1
+            store.query_batcher.close()
+            logger.info(f"Evicted vector store shard {name} ({store.memory_bytes} bytes)")
+
+    def save_all(self) -> None:
+        """Snapshot every resident shard that changed since its last snapshot."""
+        with self._lock:
+            shards = list(self._shards.items())
+        for name, store in shards:
+            if store.is_dirty:
+                store.save(utils.vector_shard_dir(name))
+
+    def stats(self) -> Dict[str, any]:
+        usage = self.memory_usage()
+        return {
+            'resident_shards': len(usage),
+            'memory_bytes': sum(usage.values()),
+            'memory_budget_bytes': self.memory_budget,
+            'loads': self.loads,
+            'evictions': self.evictions
+        }
+
+
+class SessionVectorStore:
+    """Lightweight per-session view over its group's shard of the shared store.
+
+    The encoder is shared by every session and the shard by every session of
+    the group; the view only keeps the row ids of its owner's chunks and
+    restricts searches to them. The shard is resolved through the registry
+    on each call, so the view keeps working after the shard was evicted.
+    """
+
+    def __init__(self, group: Optional[str] = None, owner: Optional[str] = None,
+                 store: Optional[VectorStore] = None, registry: Optional[ShardRegistry] = None):
+        self.group = group
+        self.owner = owner or str(uuid.uuid4())
+        self.registry = registry or get_shard_registry()
+        # A fixed store bypasses the registry (tools and benchmarks)
+        self._store = store
+        # Resolved on first use so the shard is only loaded when needed
+        self._chunk_ids: Optional[List[int]] = None
+        # Shard owner generation the ids were read at
+        self._generation: Optional[int] = None
+
+    @property
+    def store(self) -> VectorStore:
+        return self._store or self.registry.get(self.group)
+
+    def _lease(self):
+        if self._store is not None:
+            return nullcontext(self._store)
+        return self.registry.lease(self.group)
+
+    def _owned_ids(self, store: VectorStore) -> List[int]:
+        # Read again whenever the owner's chunks changed, also through another view: background
+        # jobs resumed after a restart or adopted from an earlier session index through their own
+        generation = store.owner_generation(self.owner)
+        if self._chunk_ids is None or generation != self._generation:
+            # Documents this owner added earlier (e.g. restored from a snapshot) stay visible
+            self._chunk_ids = store.chunk_ids_for_owner(self.owner)
+            self._generation = generation
+        return self._chunk_ids
+
+    @property
+    def chunk_ids(self) -> List[int]:
+        with self._lease() as store:
+            return self._owned_ids(store)
+
+    def add_documents(self, chunks: Iterable[str], doc_metadata: Dict[str, any], **kwargs) -> List[int]:
+        """Add document chunks to the group's shard and make them visible to this session.
+
+        Each batch becomes searchable for the session as soon as it is indexed.
+        """
+        on_batch = kwargs.pop('on_batch', None)
+        with self._lease() as store:
+
+            def batch_indexed(ids: List[int]) -> None:
+                # Cached answers of the group were given without these chunks
+                get_answer_cache().invalidate(self.group)
+                if on_batch:
+                    on_batch(ids)
+
+            return store.add_documents(chunks, doc_metadata, owner=self.owner, on_batch=batch_indexed, **kwargs)
+
+    def attach_document(self, document_id: str, filename: Optional[str] = None) -> Optional[List[int]]:
+        """Make an already indexed document of the group's shard visible to this session.
+
+        filename is the name this session uploaded it under.
+        """
+        with self._lease() as store:
+            # Visible from the next search on, through the shard's owner generation
+            return store.attach_document(document_id, self.owner, filename)
+
+    def get_document_stats(self) -> Dict[str, any]:
+        """Get statistics about stored documents."""
+        return self.store.get_document_stats()
+
+    def get_relevant_context(self, query: str, k: int = 5, **search_params) -> Tuple[str, List[Dict[str, any]]]:
+        """Retrieve relevant context from this session's documents only."""
+        with self._lease() as store:
+            return store.get_relevant_context(query, k, allowed_ids=self._owned_ids(store), owner=self.owner,
+                                              **search_params)
+
+    def query_embedding(self, query: str) -> np.ndarray:
+        """Normalized embedding of a query (see VectorStore.query_embedding)."""
+        with self._lease() as store:
+            return store.query_embedding(query)